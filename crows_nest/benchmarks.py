@@ -0,0 +1,117 @@
+# here one can find small benchmarks to compare different
+# implementations of the same step of the datamining.
+import os
+import time
+
+from image_manipulation import FileStitcher
+from image_manipulation import STITCH_MODES
+
+# budgets (s) of the import time of modules, heavy dependencies (e.g.
+# rioxarray, dask, cv2 or the intake catalog) should only be loaded on use
+IMPORT_BUDGETS = {
+    "database_classes": 0.5,
+    "image_manipulation": 0.5,
+    "new_naip": 0.75,
+    "multidb_wrapper": 0.75
+}
+
+
+# compare the mosaic with the feature matching stitcher
+def benchmark_stitching(location, list_of_images, tile_size_in_pixels,
+                        features=["rgb", "ir"], repeats=3, silent=False):
+    '''
+    Time the tile extraction of all stitch modes for the same location and
+    images.
+    
+    A dictionary with the mean time (s) per stitch mode is returned. Modes
+    that fail (e.g. cv2 on low-texture images) are reported as `None`.
+    '''
+    from tempfile import TemporaryDirectory
+    
+    timings = {}
+    with TemporaryDirectory() as temp_dir:
+        for stitch_mode in STITCH_MODES:
+            stitcher = FileStitcher(tile_size_in_pixels, features, silent=True,
+                                    stitch_mode=stitch_mode)
+            for feature in features:
+                os.makedirs(os.path.join(temp_dir, stitch_mode, feature))
+            file_name_prefix = os.path.join(
+                temp_dir, stitch_mode, "FEATURE_PLACE_HOLDER", "benchmark")
+            
+            durations = []
+            for _ in range(repeats):
+                start = time.perf_counter()
+                try:
+                    stitcher.stitch_image(location, list_of_images,
+                                          file_name_prefix=file_name_prefix)
+                except (AssertionError, ValueError) as err:
+                    if not silent : print(
+                        f"Stitch mode `{stitch_mode}` failed with: {err}")
+                    durations = None
+                    break
+                durations.append(time.perf_counter() - start)
+            timings[stitch_mode] = (None if durations is None else
+                                    sum(durations)/len(durations))
+    
+    if not silent:
+        print(f"Stitching of {len(list_of_images)} image(s) to a tile of "
+              f"{tile_size_in_pixels} px (mean of {repeats} runs):")
+        for stitch_mode, duration in timings.items():
+            print(f"    - {stitch_mode}: " + (
+                "failed" if duration is None else f"{duration:.4f} s"))
+    return timings
+
+
+# check that importing the modules stays cheap
+def benchmark_imports(budgets=IMPORT_BUDGETS, repeats=3, silent=False):
+    '''
+    Time the import of modules, each in a fresh interpreter (as for a
+    command line call or a spawned worker), with `python -X importtime`.
+    
+    A dictionary with the fastest import time (s) of each module is
+    returned. If modules exceed their budget (s), a RuntimeError is raised.
+    '''
+    import subprocess
+    import sys
+    
+    module_dir = os.path.dirname(os.path.abspath(__file__))
+    timings = {}
+    for module in budgets:
+        durations = []
+        for _ in range(repeats):
+            result = subprocess.run(
+                [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                cwd=module_dir, capture_output=True, text=True)
+            if result.returncode != 0:
+                raise RuntimeError(
+                    f"The module `{module}` could not be imported:\n{result.stderr[-500:]}")
+            durations.append(_get_import_time(result.stderr, module))
+        timings[module] = min(durations)
+    
+    exceeded = [module for module, duration in timings.items()
+                if duration > budgets[module]]
+    if not silent:
+        print(f"Import times (fastest of {repeats} runs):")
+        for module, duration in timings.items():
+            print(f"    - {module}: {duration:.3f} s (budget {budgets[module]:.3f} s)" + (
+                " exceeded" if module in exceeded else ""))
+    if len(exceeded) > 0:
+        raise RuntimeError(
+            f"The import of {exceeded} exceeded the budget, check for heavy "
+            f"dependencies imported at module level.")
+    return timings
+
+
+# helpers
+def _get_import_time(import_time_log, module):
+    '''
+    Return the cumulative import time (s) of a module from the log of
+    `python -X importtime`.
+    '''
+    for line in import_time_log.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, _, cumulative, name = [part.strip() for part in line.replace(":", "|", 1).split("|")]
+        if name == module:
+            return int(cumulative)/1e6
+    raise ValueError(f"The import of `{module}` is not in the log.")
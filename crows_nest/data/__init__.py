@@ -1,5 +1,4 @@
 import os
-from intake import open_catalog
 
 __CATALOG_NAME = "catalog.yaml"
 
@@ -7,5 +6,24 @@ __CATALOG_NAME = "catalog.yaml"
 # which is where the catalog resides.
 catalog_dir = os.path.dirname(os.path.abspath(__file__))
 
-# we load the catalog
-cat = open_catalog(os.path.join(catalog_dir, __CATALOG_NAME))
\ No newline at end of file
+# the catalog is only parsed (and intake imported) on first use
+_catalog = None
+
+
+def get_catalog():
+    '''
+    Return the intake catalog, which is loaded on the first call.
+    '''
+    global _catalog
+    if _catalog is None:
+        from intake import open_catalog
+        
+        _catalog = open_catalog(os.path.join(catalog_dir, __CATALOG_NAME))
+    return _catalog
+
+
+def __getattr__(name):
+    # `from data import cat` still works, but loads the catalog lazily
+    if name == "cat":
+        return get_catalog()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
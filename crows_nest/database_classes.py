@@ -7,27 +7,37 @@ from datetime import date
 import json
 import os
 import pickle
-import rtree
 import urllib
 
-from data import cat
+from data import get_catalog
 
 from utils import set_directory
 from utils import download_to_path
-from utils import check_locations_and_dates
+from location_plan import LocationStream
+from run_metrics import RunMetrics
+from utils import migrate_csv_header
+from utils import reset_made_directories
 from utils import write_csv_row
 
 from reader import LocalReader
 from reader import RemoteReader
 
+# the ways how the locations of a run can be processed
+EXECUTORS = ["serial", "threads", "processes"]
+
+# the dataminer of a worker process (see `_initialize_process_worker`)
+_WORKER_DATAMINER = None
+
+# the sources of all databases (see `load_remote_sources`)
+_REMOTE_SOURCES = None
+
 # Core abstract class that provides important methods for all subclasses
 class SpatialData(metaclass=ABCMeta):
     '''
     Base class for all spatial dataminers.
     '''
-    # statically load the sources for all databases
-    with open("remote_sources.json", "r") as rs_file:
-        REMOTE_SOURCE = json.load(rs_file)
+    # the sources for all databases are loaded on first access
+    REMOTE_SOURCE = property(lambda self: load_remote_sources())
     
     # classic init
     def __init__(self, destination_path=None, remote_url=None, features=[],
@@ -39,6 +49,9 @@ class SpatialData(metaclass=ABCMeta):
         # print or no print?
         self.silent = silent
         
+        # counters and durations of the stages (renewed for each run)
+        self.metrics = RunMetrics()
+        
         # set root and database dir
         self.set_db_directory(destination_path)
         
@@ -106,21 +119,307 @@ class SpatialData(metaclass=ABCMeta):
         return
 
     # produce query, request and store data
-    def run(self, locations, dates=None):
+    def run(self, locations, dates=None, executor="serial", workers=None,
+            chunk_size=1, ordered=True, journal=None, retry_failed=False,
+            progress_interval=None, deduplicate=False, worker_budget=None):
         '''
         try to download data from defined database for given location.
+        
+        The locations can be processed `serial`ly or by a pool of `workers`
+        `threads` or `processes`, which take `chunk_size` locations at once.
+        With `ordered` the chunks are concluded in the order of the locations.
+        With a `worker_budget` (a semaphore shared e.g. by concurrent
+        dataminers) each thread holds one of its slots while running a chunk.
+        
+        Locations can be shapely points or a `Locations` container. Instead
+        of locations and dates a `LocationPlan` (e.g. shared by multiple
+        dataminers) can be given. The locations are processed in spatial
+        order, with `deduplicate` repeated locations only once (they get no
+        outputs of their own). Iterables of unknown length (e.g. a
+        `LocationStream` reading a file) are planned and processed chunk by
+        chunk.
+        
+        With a `journal` (a `RunJournal` or the path of its file) the state
+        of each location is recorded, locations failing for lack of data
+        (assertions or value errors) are skipped and a run with the same
+        journal resumes after the concluded locations (failed ones are only
+        repeated with `retry_failed`).
+        
+        Counters and durations of the stages are exported as JSON and
+        Prometheus text file to the database directory at the end, every
+        `progress_interval` seconds a progress line is printed.
         '''
+        from concurrent.futures import ProcessPoolExecutor
+        from concurrent.futures import ThreadPoolExecutor
+        from concurrent.futures import as_completed
+        from functools import partial
+        import threading
+        from run_journal import RunJournal
+        
+        if executor not in EXECUTORS:
+            raise RuntimeError(
+                f"Attention: Executor `{executor}` is not "
+                f"implemented. Use one of those: {EXECUTORS}")
+        
         self.authenticate()
-        self.size = len(locations)
-        # for each location we should have a respective date
-        dates = check_locations_and_dates(locations, dates)
-
+        self.set_metrics(RunMetrics(progress_interval))
+        # directories removed since a former run are made again
+        reset_made_directories()
+        # for each location we should have a respective date. the total
+        # number of locations is unknown (None) for streams.
+        location_stream = LocationStream.from_input(locations, dates, silent=self.silent)
+        self.size = location_stream.total_number
+        run_journal = (RunJournal(journal, silent=self.silent) if isinstance(journal, str)
+                       else journal)
+        
         # the search should be run for each location
-        for idx, (location, dt) in enumerate(zip(locations, dates)):
-            file_name = self.make_file_name(idx, self.size)
-            queries = self.build_query(location, dt)
-            data_files = self.get_data(queries, file_name, location, date_given=dt)
-            
+        done = 0
+        if executor == "serial":
+            record = None if run_journal is None else run_journal.record
+            for plan in location_stream:
+                tasks = _schedule_tasks(plan, run_journal, retry_failed, deduplicate)
+                # concluded and repeated locations count as done
+                done += plan.size - len(tasks)
+                for task in tasks:
+                    _run_tasks(self, [task], record)
+                    done += 1
+                    self.metrics.report_progress(done, self.size)
+            # conclude the run, e.g. store aggregated information
+            self.finalize()
+            _close_journal(run_journal, journal)
+            self.export_metrics(done)
+            return
+        
+        # shared state (e.g. indices) is set up once before the workers start
+        self.prepare_workers(executor)
+        if executor == "threads":
+            # each thread gets its own dataminer from `make_worker`
+            local = threading.local()
+            def initialize_thread():
+                local.dataminer = self.make_worker()
+            def run_chunk(chunk):
+                record = None if run_journal is None else run_journal.record
+                # the metrics are shared by the threads
+                if worker_budget is None:
+                    return [], None, _run_chunk(local.dataminer, chunk, record)
+                with worker_budget:
+                    return [], None, _run_chunk(local.dataminer, chunk, record)
+            pool = ThreadPoolExecutor(max_workers=workers, initializer=initialize_thread)
+        else:
+            # processes hand the journal entries back with their results
+            run_chunk = partial(_run_chunk_in_process, journaled=run_journal is not None)
+            pool = ProcessPoolExecutor(max_workers=workers,
+                                       initializer=_initialize_process_worker,
+                                       initargs=(self,))
+        
+        # results of the workers (e.g. statistics) are merged here. only the
+        # locations of one plan are in flight at a time.
+        with pool:
+            for plan in location_stream:
+                tasks = _schedule_tasks(plan, run_journal, retry_failed, deduplicate)
+                # concluded and repeated locations count as done
+                done += plan.size - len(tasks)
+                chunks = [tasks[i:i+chunk_size] for i in range(0, len(tasks), chunk_size)]
+                if ordered:
+                    worker_results = zip(chunks, pool.map(run_chunk, chunks))
+                else:
+                    futures = {pool.submit(run_chunk, chunk): chunk for chunk in chunks}
+                    worker_results = ((futures[future], future.result())
+                                      for future in as_completed(futures))
+                for chunk, (journal_entries, worker_metrics, worker_result) in worker_results:
+                    for journal_entry in journal_entries:
+                        run_journal.record(*journal_entry)
+                    if worker_metrics is not None:
+                        self.metrics.merge(worker_metrics)
+                    self.merge_worker_results(worker_result)
+                    done += len(chunk)
+                    self.metrics.report_progress(done, self.size)
+        
+        # conclude the run, e.g. store aggregated information
+        self.finalize()
+        _close_journal(run_journal, journal)
+        self.export_metrics(done)
+        return
+    
+    # estimate the cost of a run without fetching data
+    def plan(self, locations, dates=None, probe_sizes=True, probe_workers=16,
+             download_rate=20e6, location_time=0.2, deduplicate=False, journal=None,
+             retry_failed=False):
+        '''
+        Select the source files of all locations (as a run would) and report
+        the cost of the run, without downloading pixel data or setting up
+        the outputs.
+        
+        As in `run`, repeated locations are only planned once with
+        `deduplicate` and locations concluded in the `journal` (a
+        `RunJournal` or the path of its file) are left out.
+        
+        Source files are deduplicated over all locations. The size of cached
+        files is taken from the cache, the one of missing files is probed
+        with HEAD requests (by `probe_workers` threads, if `probe_sizes`).
+        The duration is estimated from the `download_rate` (bytes/s) and the
+        time to stitch and store a location (`location_time` in s).
+        
+        A dictionary with the report is returned.
+        '''
+        from concurrent.futures import ThreadPoolExecutor
+        from run_journal import RunJournal
+        from run_journal import make_location_key
+        
+        self.authenticate()
+        location_stream = LocationStream.from_input(locations, dates, silent=self.silent)
+        # the journal is only read (a missing one concluded nothing)
+        run_journal = journal
+        if isinstance(journal, str):
+            run_journal = RunJournal(journal, silent=self.silent) if os.path.exists(journal) else None
+        
+        # the source files of all locations, a run would process
+        number_of_locations = 0
+        concluded_locations = 0
+        failed_locations = 0
+        source_files = set()
+        for idx, location, dt in location_stream.iter_tasks(deduplicate=deduplicate):
+            if run_journal is not None and run_journal.is_finished(
+                    idx, make_location_key(location, dt), retry_failed):
+                concluded_locations += 1
+                continue
+            number_of_locations += 1
+            try:
+                source_files.update(self.build_dry_query(location, dt))
+            except (AssertionError, ValueError):
+                failed_locations += 1
+        if isinstance(journal, str) and run_journal is not None:
+            run_journal.close()
+        
+        # cached files are found in the destination, others are probed
+        cached_bytes = 0
+        missing_urls = []
+        for source_file_query in sorted(source_files):
+            dest_file_path = self.datasource.destination.make_dest_file_path(
+                self.get_local_src_dest_path(source_file_query))
+            if os.path.exists(dest_file_path):
+                cached_bytes += os.path.getsize(dest_file_path)
+            else:
+                missing_urls.append(self.datasource.fetch_data(
+                    source_file_query, None, dry_run=True))
+        missing_sizes = [None]*len(missing_urls)
+        if probe_sizes and len(missing_urls) > 0:
+            with ThreadPoolExecutor(max_workers=probe_workers) as pool:
+                missing_sizes = list(pool.map(_probe_file_size, missing_urls))
+        download_bytes = sum(size for size in missing_sizes if size is not None)
+        
+        report = {
+            "database": self.DATABASE,
+            "locations": number_of_locations,
+            "locations_concluded": concluded_locations,
+            "locations_without_data": failed_locations,
+            "source_files": len(source_files),
+            "cached_files": len(source_files) - len(missing_urls),
+            "cached_bytes": cached_bytes,
+            "download_files": len(missing_urls),
+            "download_bytes": download_bytes,
+            "unknown_sizes": sum(size is None for size in missing_sizes),
+            "estimated_duration": (download_bytes/download_rate
+                                   + number_of_locations*location_time)
+        }
+        if not self.silent:
+            print(f"Plan of `{self.DATABASE}`:")
+            print(f"    - locations: {report['locations']} "
+                  f"({report['locations_without_data']} without data, "
+                  f"{report['locations_concluded']} concluded before)")
+            print(f"    - source files: {report['source_files']} "
+                  f"({report['cached_files']} cached, {report['cached_bytes']/1e6:.1f} MB)")
+            print(f"    - downloads: {report['download_files']} files, "
+                  f"{report['download_bytes']/1e6:.1f} MB"
+                  f" ({report['unknown_sizes']} of unknown size)")
+            print(f"    - estimated duration: {report['estimated_duration']/60:.1f} min")
+        return report
+    
+    def build_dry_query(self, location, dt):
+        '''
+        Build the query of a location for a dry run (see `plan`), which does
+        not set up the outputs. By default the query is built as in a run.
+        '''
+        return self.build_query(location, dt)
+    
+    def run_location(self, idx, location, dt):
+        '''
+        Query, request and store the data for one location.
+        
+        `"skipped"` is returned, if the outputs of the location existed
+        already (e.g. from a former run).
+        '''
+        file_name = self.make_file_name(idx, self.size)
+        queries = self.build_query(location, dt)
+        return self.get_data(queries, file_name, location, date_given=dt)
+    
+    def set_metrics(self, metrics):
+        '''
+        Collect counters and durations of the stages in the given metrics.
+        '''
+        self.metrics = metrics
+        return
+    
+    def export_metrics(self, done=None):
+        '''
+        Store the metrics of a run in the database directory (as JSON and
+        Prometheus text file) and print the last progress line.
+        '''
+        if done is not None and self.metrics.progress_interval is not None:
+            self.metrics.report_progress(done, self.size, force=True)
+        os.makedirs(self.database_dir, exist_ok=True)
+        self.metrics.export(os.path.join(self.database_dir, f"metrics_{self.db_name}"),
+                            silent=self.silent)
+        return
+    
+    def record_state(self, state, reason=None):
+        '''
+        Record a state (e.g. `fetched`) of the location processed by this
+        dataminer in the journal of the run (if there is one).
+        
+        Only dataminers with own copies for their workers (see `make_worker`)
+        can record states in parallel runs.
+        '''
+        journal_task = getattr(self, "journal_task", None)
+        if journal_task is not None:
+            journal_task[2](journal_task[0], journal_task[1], state, reason)
+        return
+    
+    def prepare_workers(self, executor):
+        '''
+        Set up everything the workers (`threads` or `processes`) of a
+        parallel run share (nothing to do by default).
+        '''
+        return
+    
+    def make_worker(self):
+        '''
+        Return the dataminer of a worker, called once in each worker.
+        
+        By default all workers share this dataminer. Subclasses with state
+        that is not thread-safe (e.g. index handles) return copies with
+        their own state.
+        '''
+        return self
+    
+    def export_worker_results(self):
+        '''
+        Return the results of a worker (e.g. statistics), which are handed to
+        `merge_worker_results` of the main dataminer (nothing by default).
+        '''
+        return None
+    
+    def merge_worker_results(self, worker_results):
+        '''
+        Merge the results of a worker into this dataminer (nothing to do by
+        default).
+        '''
+        return
+    
+    def finalize(self):
+        '''
+        Conclude a run of the dataminer (nothing to do by default).
+        '''
         return
 
     # set a directory for databaseminer class and store in self
@@ -159,11 +458,12 @@ class SpatialData(metaclass=ABCMeta):
         '''
         self.get_std_name()
         
-        self.remote_function = cat[self.db_name]
-        self.remote_url = cat[self.db_name](filename="").urlpath.strip("/")
-        self.index_url = cat[self.db_name].metadata["index_url"]
-        self.index_files = cat[self.db_name].metadata["index_files"]
-        self.features_possible = cat[self.db_name].metadata["features"]
+        catalog = get_catalog()
+        self.remote_function = catalog[self.db_name]
+        self.remote_url = catalog[self.db_name](filename="").urlpath.strip("/")
+        self.index_url = catalog[self.db_name].metadata["index_url"]
+        self.index_files = catalog[self.db_name].metadata["index_files"]
+        self.features_possible = catalog[self.db_name].metadata["features"]
         return
     
     
@@ -227,6 +527,10 @@ class SpatialData(metaclass=ABCMeta):
                 ""
             ).replace("_.csv", "_cache.csv")
         
+        # files of former versions get the new columns (e.g. band statistics)
+        if migrate_csv_header(csv_file_name, header_dict.keys()):
+            if not self.silent : print(
+                f"The columns of `{csv_file_name}` were extended to the current header.")
         write_csv_row(csv_file_name, header_dict)
         return csv_file_name
 
@@ -312,10 +616,150 @@ class SpatialData(metaclass=ABCMeta):
         '''
         if not hasattr(self, "db_name"):
             self.get_std_name()
-        self.cat = cat[self.db_name]
+        self.cat = get_catalog()[self.db_name]
         return
     
 # end SpatialData
+
+
+def load_remote_sources():
+    '''
+    Return the sources of all databases from `remote_sources.json` (next to
+    this module), which is read on the first call.
+    '''
+    global _REMOTE_SOURCES
+    if _REMOTE_SOURCES is None:
+        remote_sources_path = os.path.join(
+            os.path.dirname(os.path.abspath(__file__)), "remote_sources.json")
+        with open(remote_sources_path, "r") as rs_file:
+            _REMOTE_SOURCES = json.load(rs_file)
+    return _REMOTE_SOURCES
+
+
+# helpers for plans of runs
+def _probe_file_size(url):
+    '''
+    Return the size of a (local or remote) file in bytes, remote files are
+    asked by a HEAD request (None if the size is unknown).
+    '''
+    import urllib.request
+    from urllib.error import HTTPError
+    from urllib.error import URLError
+    
+    if os.path.exists(url):
+        return os.path.getsize(url)
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, method="HEAD"),
+                                    timeout=30) as response:
+            content_length = response.headers.get("Content-Length")
+    except (HTTPError, URLError, ValueError, OSError):
+        return None
+    return None if content_length is None else int(content_length)
+
+
+# helpers for the journal of runs
+def _schedule_tasks(plan, run_journal, retry_failed=False, deduplicate=False):
+    '''
+    Return the tasks of a plan, which are not concluded in the journal, and
+    record them as planned.
+    '''
+    from run_journal import make_location_key
+    
+    if run_journal is None:
+        return list(plan.iter_tasks(deduplicate=deduplicate))
+    tasks = []
+    for idx, location, dt in plan.iter_tasks(deduplicate=deduplicate):
+        location_key = make_location_key(location, dt)
+        if run_journal.is_finished(idx, location_key, retry_failed):
+            continue
+        run_journal.record(idx, location_key, "planned")
+        tasks.append((idx, location, dt))
+    return tasks
+
+
+def _run_tasks(dataminer, tasks, record=None):
+    '''
+    Run locations with a dataminer. With a `record` function (of a journal)
+    their states are recorded and locations lacking data are skipped.
+    
+    A location is only recorded as written, if the dataminer did not record
+    it as failed itself (e.g. when its tiles could not be stitched).
+    Locations are counted in the metrics by their outcome (written, failed
+    or skipped, if `run_location` reports that the outputs existed).
+    '''
+    from run_journal import make_location_key
+    
+    for idx, location, dt in tasks:
+        location_key = make_location_key(location, dt)
+        task_states = []
+        def record_task(idx, location_key, state, reason=None):
+            task_states.append(state)
+            if record is not None:
+                record(idx, location_key, state, reason)
+        dataminer.journal_task = (idx, location_key, record_task)
+        try:
+            with dataminer.metrics.time_stage("location"):
+                location_status = dataminer.run_location(idx, location, dt)
+        except (AssertionError, ValueError) as err:
+            if record is None:
+                raise
+            record(idx, location_key, "failed", repr(err))
+            dataminer.metrics.count("locations_total", status="failed")
+            if not dataminer.silent : print(
+                f"The location with index {idx} failed and is skipped: {err}")
+            continue
+        except Exception as err:
+            if record is not None:
+                record(idx, location_key, "failed", repr(err))
+            raise
+        finally:
+            dataminer.journal_task = None
+        if "failed" in task_states:
+            dataminer.metrics.count("locations_total", status="failed")
+            continue
+        if record is not None:
+            record(idx, location_key, "written")
+        dataminer.metrics.count("locations_total",
+                                status="skipped" if location_status == "skipped" else "written")
+    return
+
+
+def _close_journal(run_journal, journal):
+    '''
+    Close a journal opened by the run (given as path).
+    '''
+    if run_journal is not None and run_journal is not journal:
+        run_journal.close()
+    return
+
+
+# helpers for the workers of parallel runs
+def _run_chunk(dataminer, chunk, record=None):
+    '''
+    Run a chunk of locations with a dataminer and return its results.
+    '''
+    _run_tasks(dataminer, chunk, record)
+    return dataminer.export_worker_results()
+
+
+def _initialize_process_worker(dataminer):
+    '''
+    Store the dataminer of a worker process.
+    '''
+    global _WORKER_DATAMINER
+    _WORKER_DATAMINER = dataminer.make_worker()
+    return
+
+
+def _run_chunk_in_process(chunk, journaled=False):
+    '''
+    Run a chunk of locations with the dataminer of the worker process and
+    return the entries for the journal, its metrics and its results.
+    '''
+    journal_entries = []
+    record = (lambda *journal_entry: journal_entries.append(journal_entry)) if journaled else None
+    worker_result = _run_chunk(_WORKER_DATAMINER, chunk, record)
+    return journal_entries, _WORKER_DATAMINER.metrics.pop_metrics(), worker_result
     
     
 # metaclass to assemble csv files for metainformation
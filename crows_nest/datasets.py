@@ -0,0 +1,91 @@
+# here one can find datasets, which provide the tiles of a table of
+# locations by index (map-style), e.g. for the data loaders of
+# machine learning frameworks.
+import os
+
+from location_plan import LocationPlan
+from location_plan import make_location_id
+from new_naip import NAIPData
+from output_sinks import ArrayStoreSink
+from output_sinks import MemorySink
+from output_sinks import TarShardSink
+
+
+## classes ##
+class NAIPTileDataset:
+    '''
+    Map-style dataset of the NAIP tiles around a list of locations.
+    
+    Each item is a tuple of the tile arrays by feature and their
+    metadata (a list of those for each acquisition in time series
+    mode). The dataset can be used by multiple loader workers: the
+    dataminer reloads its tile index in each (forked or spawned)
+    worker process, while all workers share the raw tile cache of
+    the database directory. Tiles can only be written to an array
+    store or tar shards without loader workers (`num_workers=0`), as
+    the processes would append to the same store or shard.
+    '''
+    def __init__(self, locations, dates=None, write=False, **naip_kwargs):
+        '''
+        Construct with locations (and dates) or a location plan and the
+        arguments of the dataminer (`NAIPData`).
+        
+        With `write` the tiles are also stored by the dataminer.
+        '''
+        self.plan = LocationPlan.from_input(locations, dates)
+        self.write = write
+        # loader workers are recognized by their process id
+        self.main_pid = os.getpid()
+        
+        # the index files are fetched once in the main process, so workers
+        # only need to load them. csv files and sink are only set up to write.
+        self.dataminer = NAIPData(**naip_kwargs)
+        self.dataminer.authenticate()
+        if write:
+            self.dataminer.prepare()
+            self.dataminer.prepared = True
+        else:
+            self.dataminer.prepare_index()
+        return
+    
+    
+    def __len__(self):
+        return self.plan.size
+    
+    
+    def __getitem__(self, index):
+        '''
+        Fetch and stitch the tiles of a location.
+        '''
+        if (self.write and os.getpid() != self.main_pid and
+                isinstance(self.dataminer.tile_sink, (ArrayStoreSink, TarShardSink))):
+            raise RuntimeError(
+                "Tiles can not be written to an array store or tar shards from loader "
+                "workers. Use `num_workers=0` or the `geotiff` output format.")
+        location, date_given = self.plan.get_task(index)
+        
+        # workers load their own index handle
+        self.dataminer.prepare_index()
+        build_query = self.dataminer.select_tiles(location, date_given)
+        raw_file_names = self.dataminer.fetch_tiles(build_query, location,
+                                                    cache_rows=None if self.write else [])
+        
+        memory_sink = MemorySink(silent=self.dataminer.silent)
+        stitcher_sink = self.dataminer.tile_stitcher.sink
+        self.dataminer.tile_stitcher.set_sink(memory_sink)
+        try:
+            extracted_tiles = self.dataminer.extract_tiles(
+                build_query, raw_file_names,
+                self.dataminer.make_file_name(index, len(self), location, build_query),
+                location, date_given, memory_sink, write=self.write,
+                location_id=make_location_id(index))
+        finally:
+            self.dataminer.tile_stitcher.set_sink(stitcher_sink)
+        
+        if self.dataminer.time_series:
+            return extracted_tiles
+        if len(extracted_tiles) == 0:
+            raise RuntimeError(
+                f"No tiles could be extracted for the location with index {index}.")
+        return extracted_tiles[0]
+# end NAIPTileDataset
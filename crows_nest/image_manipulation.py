@@ -1,10 +1,30 @@
 # here one can find tools for image manipulation
 import os
+import time
 from shapely.geometry import Point
-import cv2
 
+from output_sinks import GeoTiffSink
+from output_sinks import MemorySink
+from output_sinks import write_feature_tile
 from utils import coordinatify_point
+from utils import make_directory
+from run_metrics import time_stage
 
+# coordinates of the locations are given in this crs
+IO_CRS = "epsg:4326"
+# the implemented ways to merge multiple images to a tile
+STITCH_MODES = ["mosaic", "cv2"]
+# the bands (rasterio indexes) of the raw images needed for each feature.
+# for spectral indices these are the two bands (a, b) of the normalized
+# difference (a - b)/(a + b).
+FEATURE_BANDS = {
+    "rgb": [1, 2, 3],
+    "ir": [4],
+    "ndvi": [4, 1],  # (nir - red)/(nir + red)
+    "ndwi": [2, 4]  # (green - nir)/(green + nir)
+}
+# features which are computed from the bands as normalized difference
+SPECTRAL_INDICES = ["ndvi", "ndwi"]
 
 ## classes ##
 # important class to stitch multiple images to one
@@ -13,27 +33,186 @@ class FileStitcher:
     '''
     Assembler of multiple files to one tile of given
     edgelength in pixel centered around a location.
+    
+    Multiple edgelengths (scales) can be given, which are all
+    cropped from one read of the largest window.
     '''
-    def __init__(self, tile_size_in_pixels, features, silent=True):
+    def __init__(self, tile_size_in_pixels, features, silent=True,
+                 stitch_mode="mosaic", output_size=None, resampling="average"):
         '''
         Construct with database features and 
         tile sizes given.
+        
+        If an `output_size` (pixels) smaller than the tile size is given,
+        the windows are read decimated (from overviews if available).
         '''
-        self.tile_size = tile_size_in_pixels
-        self.features = features
-        self.stitcher = cv2.Stitcher_create()
+        self.set_tile_size(tile_size_in_pixels)
+        self.output_size = output_size
+        self.resampling = resampling
+        self.set_features(features)
+        self.set_stitch_mode(stitch_mode)
+        
+        # running band statistics of all stored tiles for each
+        # feature and scale
+        self.statistics = {}
+        
+        # tiles of the mosaic are stored as tif files by default
+        self.sink = GeoTiffSink(silent=silent)
+        
+        # durations of the stages are collected, if metrics are given
+        self.metrics = None
         
         self.silent = silent
 
         return
     
     
+    def set_tile_size(self, tile_size_in_pixels, scale_labels=None):
+        '''
+        Change the edgelength(s) (pixel) of the window(s) read around a location.
+        
+        For multiple edgelengths, `scale_labels` are used to name the files of
+        each scale.
+        '''
+        if isinstance(tile_size_in_pixels, (list, tuple)):
+            self.tile_sizes = list(tile_size_in_pixels)
+        else:
+            self.tile_sizes = [tile_size_in_pixels]
+        # the largest window is the one which is read
+        self.tile_size = max(self.tile_sizes)
+        if scale_labels is None:
+            scale_labels = [f"{ts}px" for ts in self.tile_sizes]
+        assert len(scale_labels) == len(self.tile_sizes), (
+            "There needs to be one label for each tile size.")
+        self.scale_labels = list(scale_labels)
+        return
+    
+    
+    def get_output_size(self, tile_size_in_pixels=None):
+        '''
+        Return the edgelength (pixel) of the stored tiles of a scale (default
+        is the largest).
+        
+        Tiles are never upsampled, so the output size is at most the tile size.
+        '''
+        if tile_size_in_pixels is None:
+            tile_size_in_pixels = self.tile_size
+        if self.output_size is None:
+            return tile_size_in_pixels
+        return min(self.output_size, tile_size_in_pixels)
+    
+    
+    def get_read_scale(self):
+        '''
+        Return the factor by which the windows can be decimated when read.
+        
+        The smallest scale must keep its output resolution, so it defines
+        how coarse the window can be read.
+        '''
+        smallest_tile_size = min(self.tile_sizes)
+        return smallest_tile_size/self.get_output_size(smallest_tile_size)
+    
+    
+    def get_tile_nbytes(self, tile_sizes_in_pixels=None, itemsize=4):
+        '''
+        Return the (maximal) number of bytes of all feature tiles of all scales
+        of one location, assuming `itemsize` bytes per pixel and band.
+        '''
+        if tile_sizes_in_pixels is None:
+            tile_sizes_in_pixels = self.tile_sizes
+        bands = sum(1 if feature in SPECTRAL_INDICES else len(FEATURE_BANDS[feature])
+                    for feature in self.features)
+        return sum(bands*self.get_output_size(tile_size)**2*itemsize
+                   for tile_size in tile_sizes_in_pixels)
+    
+    
+    def set_sink(self, sink):
+        '''
+        Change the sink in which the mosaicked tiles are stored.
+        '''
+        self.sink = sink
+        return
+    
+    
+    def set_features(self, features):
+        '''
+        Set the features and the bands that need to be read for them.
+        
+        Only the union of the bands of all features is read from the raw
+        images, `band_positions` tells where each feature is found in the
+        read array. Spectral indices are only computed in the `mosaic`
+        stitch mode.
+        '''
+        _check_stitch_mode_of_features(features, getattr(self, "stitch_mode", "mosaic"))
+        self.features = features
+        self.band_indexes = sorted(set(
+            band for feature in features for band in FEATURE_BANDS[feature]))
+        self.band_positions = {
+            feature: [self.band_indexes.index(band) for band in FEATURE_BANDS[feature]]
+            for feature in features}
+        return
+    
+    
+    def make_feature_tile(self, tile, feature):
+        '''
+        Select the bands of a feature from a tile or compute the spectral
+        index on them.
+        '''
+        import numpy as np
+        
+        feature_tile = tile[self.band_positions[feature]]
+        if feature in SPECTRAL_INDICES:
+            band_a, band_b = feature_tile.astype("float32")
+            # pixels without signal in both bands (nodata) become nan
+            with np.errstate(divide="ignore", invalid="ignore"):
+                feature_tile = ((band_a - band_b)/(band_a + band_b))[None]
+        return feature_tile
+    
+    
+    def set_stitch_mode(self, stitch_mode):
+        '''
+        Choose how multiple images are merged to one tile.
+        
+        `mosaic` places all windows by their affine transforms into
+        one georeferenced array, `cv2` uses feature matching of the
+        opencv panorama stitcher.
+        '''
+        if stitch_mode not in STITCH_MODES:
+            raise RuntimeError(
+                f"Attention: Stitch mode `{stitch_mode}` is not "
+                f"implemented. Use one of those: {STITCH_MODES}")
+        _check_stitch_mode_of_features(getattr(self, "features", []), stitch_mode)
+        self.stitch_mode = stitch_mode
+        # the feature matching stitcher is only needed for `cv2`
+        if stitch_mode == "cv2" and not hasattr(self, "stitcher"):
+            import cv2
+            
+            self.stitcher = cv2.Stitcher_create()
+        return
+    
+    
+    def __getstate__(self):
+        '''
+        Drop the opencv stitcher when pickled, it cannot be pickled.
+        '''
+        state = self.__dict__.copy()
+        state.pop("stitcher", None)
+        return state
+    
+    
+    def __setstate__(self, state):
+        '''
+        Restore a pickled stitcher and recreate the opencv stitcher if needed.
+        '''
+        self.__dict__.update(state)
+        self.set_stitch_mode(self.stitch_mode)
+        return
+    
+    
     def stitch_image(self, location, list_of_images: list, file_name_prefix=None):
         '''
         Extract and stitch (if neccessary) tile from image(s).
         '''
-        from shutil import copyfile
-
         # we construct file name from location and tilesize.
         # onecould add date
         if file_name_prefix is None:
@@ -42,6 +221,19 @@ class FileStitcher:
                 f"{_stringisize_point(location)}_{self.tile_size}px")
         else:
             filepath_prefix = os.path.abspath(file_name_prefix)
+        
+        # georeferenced images can be merged without any matching
+        if self.stitch_mode == "mosaic":
+            return self.mosaic_image(location, list_of_images, filepath_prefix)
+        
+        # opencv is only needed (and loaded) for feature matching
+        from shutil import copyfile
+        import cv2
+        
+        if len(self.tile_sizes) > 1:
+            raise ValueError(
+                "Multiple tile sizes are only supported by the `mosaic` stitch mode.")
+        
         # first temporary tile_fragments are produced from all
         # raw images and stored feature specifically.
         temp_images = []
@@ -52,6 +244,15 @@ class FileStitcher:
         # if we already retrieved a full one, we 
         # break the loop and memorize that:
         full_tile_in_list_last = False
+        # copied tiles are resampled to the output size like stitched ones
+        output_scale = self.tile_size/self.get_output_size()
+        def copy_tile(temp_image_name, final_image_name):
+            if output_scale == 1:
+                copyfile(temp_image_name, final_image_name)
+                return "none"
+            _copy_resized_tile(temp_image_name, final_image_name, output_scale,
+                               self.resampling)
+            return "none+resized"
 
         for image_path in list_of_images:
             temp_image_dict = self.make_temp_image(location, image_path)
@@ -66,9 +267,11 @@ class FileStitcher:
         for feature in self.features:
             final_image_name = f"{filepath_prefix}.tif".replace(
                     "FEATURE_PLACE_HOLDER", feature)
+            make_directory(os.path.dirname(final_image_name))
             
             # completeness, manipulations and source images are memorized
-            manipulations[final_image_name] = {}
+            manipulations[final_image_name] = {
+                "feature": feature, "scale": self.scale_labels[0]}
             
             temp_images_feature = [
                 loc_img[feature][0] for loc_img in temp_images]
@@ -85,9 +288,9 @@ class FileStitcher:
                     print("... complete tile was given")
                 chosen_rawfile = list_of_images[len(temp_images_feature)-1]
                 chosen_tile_file = temp_images_feature[-1]
-                copyfile(chosen_tile_file.name, final_image_name)
+                manipulation = copy_tile(chosen_tile_file.name, final_image_name)
                 manipulations[final_image_name]["completeness"] = "complete"
-                manipulations[final_image_name]["manipulations"] = "none"
+                manipulations[final_image_name]["manipulations"] = manipulation
                 manipulations[final_image_name]["source_file"] = chosen_rawfile
             # single files do not need to be stitched
             # TODO: we would need a checker if all images have
@@ -95,9 +298,9 @@ class FileStitcher:
             elif len(temp_images_feature) == 1:
                 if not self.silent:
                     print("... single incomplete tile was given")
-                copyfile(temp_images_feature[0].name, final_image_name)
+                manipulation = copy_tile(temp_images_feature[0].name, final_image_name)
                 manipulations[final_image_name]["completeness"] = "incomplete"
-                manipulations[final_image_name]["manipulations"] = "none"
+                manipulations[final_image_name]["manipulations"] = manipulation
                 manipulations[final_image_name]["source_file"] = list_of_images[0]
             # stitch multiple tiles
             else:
@@ -113,10 +316,11 @@ class FileStitcher:
                 manipulations[final_image_name]["manipulations"] = "stitched"
                 manipulations[final_image_name]["source_file"] = "|".join(list_of_images)
                 # some images do not fit the pixel dimensions anymore
-                if (stitched_image.shape[0] != self.tile_size or
-                    stitched_image.shape[0] != self.tile_size):
+                output_size = self.get_output_size()
+                if (stitched_image.shape[0] != output_size or
+                    stitched_image.shape[0] != output_size):
                     final_image = cv2.resize(stitched_image,
-                                             (self.tile_size, self.tile_size))
+                                             (output_size, output_size))
                     manipulations[final_image_name]["manipulations"] += "+resized"
                 else:
                     final_image = stitched_image
@@ -130,6 +334,245 @@ class FileStitcher:
         return manipulations
     
     
+    def make_final_image_name(self, filepath_prefix, feature, scale_label):
+        '''
+        Return the file name of the tile of a feature and scale.
+        '''
+        # only with multiple scales the file names are extended
+        if len(self.tile_sizes) > 1:
+            filepath_prefix = f"{filepath_prefix}_{scale_label}"
+        return f"{filepath_prefix}.tif".replace("FEATURE_PLACE_HOLDER", feature)
+    
+    
+    def has_tiles(self, file_name_prefix, scale_labels=None):
+        '''
+        Check if the sink already holds the tiles of all features and scales
+        for a file name prefix (e.g. from a former run).
+        
+        The `scale_labels` of the tiles default to the ones set last.
+        '''
+        if scale_labels is None:
+            scale_labels = self.scale_labels
+        filepath_prefix = os.path.abspath(file_name_prefix)
+        return all(
+            self.sink.has_tile(self.make_final_image_name(filepath_prefix, feature, scale_label),
+                               feature, scale_label)
+            for feature in self.features for scale_label in scale_labels)
+    
+    
+    def mosaic_image(self, location, list_of_images: list, filepath_prefix):
+        '''
+        Merge the windows of image(s) to a georeferenced tile and store it
+        for each feature.
+        '''
+        with time_stage(self.metrics, "mosaic"):
+            mosaic, covered, profile, used_images = self.make_mosaic(
+                location, list_of_images)
+        with time_stage(self.metrics, "resize"):
+            scale_tiles = list(self.make_scale_tiles(mosaic, covered, profile))
+        
+        # the features and the encoding are timed once for all tiles of the
+        # location (a memory sink without a sink below does not encode)
+        encodes = not (isinstance(self.sink, MemorySink) and self.sink.sink is None)
+        feature_duration = encode_duration = 0.0
+        manipulations = {}
+        for scale_label, (tile, tile_covered, tile_profile, manipulation) in zip(
+                self.scale_labels, scale_tiles):
+            manipulation = ("mosaicked" if len(used_images) > 1 else "none") + manipulation
+            
+            for feature in self.features:
+                final_image_name = self.make_final_image_name(
+                    filepath_prefix, feature, scale_label)
+                start = time.perf_counter()
+                feature_tile = self.make_feature_tile(tile, feature)
+                feature_duration += time.perf_counter() - start
+                start = time.perf_counter()
+                file_path, image_info_dict = self.sink.write_tile(
+                    final_image_name, feature, scale_label, feature_tile, tile_profile)
+                encode_duration += time.perf_counter() - start
+                if not self.silent:
+                    print(f"File saved: {file_path}...")
+                
+                # statistics are computed while the tile is in memory
+                tile_statistics = self.update_statistics(
+                    feature, scale_label, feature_tile, tile_covered)
+                
+                # completeness, manipulations and source images are memorized
+                manipulations[final_image_name] = {
+                    "feature": feature,
+                    "scale": scale_label,
+                    "completeness": ("complete" if tile_statistics["nodata_fraction"] == 0
+                                     else "incomplete"),
+                    "manipulations": manipulation,
+                    "source_file": "|".join(used_images),
+                    "file_path": file_path,
+                    "image_info": image_info_dict,
+                    "crs": str(tile_profile["crs"]),
+                    "transform": "|".join(str(t) for t in tile_profile["transform"][:6]),
+                    **tile_statistics
+                }
+        if self.metrics is not None:
+            self.metrics.observe("feature", feature_duration)
+            if encodes:
+                self.metrics.observe("encode", encode_duration)
+        return manipulations
+    
+    
+    def merge_statistics(self, statistics):
+        '''
+        Add the running band statistics of another stitcher (e.g. of a worker).
+        '''
+        for statistics_key, band_statistics in statistics.items():
+            if statistics_key in self.statistics:
+                self.statistics[statistics_key].merge(band_statistics)
+            else:
+                self.statistics[statistics_key] = band_statistics
+        return
+    
+    
+    def update_statistics(self, feature, scale_label, feature_tile, covered):
+        '''
+        Compute the band statistics of a tile and add them to the running
+        statistics of its feature and scale.
+        
+        The tile statistics are returned as dictionary.
+        '''
+        import numpy as np
+        
+        # nodata are pixels without any source data and nan (indices)
+        valid = covered.copy()
+        if np.issubdtype(feature_tile.dtype, np.floating):
+            valid &= ~np.isnan(feature_tile).any(axis=0)
+        
+        if (feature, scale_label) not in self.statistics:
+            self.statistics[(feature, scale_label)] = BandStatistics(
+                feature_tile.shape[0], feature_tile.dtype)
+        tile_statistics = BandStatistics(feature_tile.shape[0], feature_tile.dtype)
+        tile_statistics.update(feature_tile, valid)
+        self.statistics[(feature, scale_label)].merge(tile_statistics)
+        
+        return {
+            "nodata_fraction": tile_statistics.get_nodata_fraction(),
+            "band_mean": "|".join(f"{m:.4f}" for m in tile_statistics.mean),
+            "band_std": "|".join(f"{s:.4f}" for s in tile_statistics.get_std())
+        }
+    
+    
+    def make_scale_tiles(self, mosaic, covered, profile):
+        '''
+        Crop the tiles of all scales centered from the mosaic of the largest
+        window and resample them to their output size.
+        
+        A list of tuples (tile, coverage, profile, manipulation) in order
+        of the tile sizes is returned.
+        '''
+        from rasterio.transform import Affine
+        
+        read_scale = self.get_read_scale()
+        mosaic_size = mosaic.shape[1]
+        
+        scale_tiles = []
+        for tile_size in self.tile_sizes:
+            crop_size = int(round(tile_size/read_scale))
+            output_size = self.get_output_size(tile_size)
+            manipulation = "+decimated" if read_scale != 1 else ""
+            
+            # tile sizes are even, so the crops stay centered
+            offset = (mosaic_size - crop_size)//2
+            crop = (slice(offset, offset + crop_size),)*2
+            tile = mosaic[(slice(None),) + crop]
+            tile_covered = covered[crop]
+            if crop_size != mosaic_size:
+                manipulation += "+cropped"
+            if crop_size != output_size:
+                tile = _resize_bands(tile, output_size, self.resampling)
+                tile_covered = _resize_bands(
+                    tile_covered[None].astype("uint8"), output_size, "nearest")[0] > 0
+                manipulation += "+resized"
+            
+            tile_profile = profile.copy()
+            tile_profile.update({
+                "height": output_size,
+                "width": output_size,
+                "transform": (profile["transform"] *
+                              Affine.translation(offset, offset) *
+                              Affine.scale(crop_size/output_size))
+            })
+            scale_tiles.append((tile, tile_covered, tile_profile, manipulation))
+        return scale_tiles
+    
+    
+    def make_mosaic(self, location, list_of_images: list):
+        '''
+        Place the windows around a location of all given images into one
+        pre-allocated array by their affine transforms.
+        
+        The first image defines crs and pixel grid of the mosaic. Images on
+        the same grid are copied, others are reprojected. As in
+        `rasterio.merge`, pixels which are already covered are not overwritten.
+        For output sizes below the tile size, the pixel grid is coarsened and
+        the windows are decoded at the target resolution.
+        '''
+        import numpy as np
+        import rasterio
+        from rasterio.enums import Resampling
+        from rasterio.transform import Affine
+        from rasterio.warp import transform
+
+        # we will work a lot with the half tile size
+        half_edge = int(self.tile_size/2)
+        scale = self.get_read_scale()
+        mosaic_size = int(round(self.tile_size/scale))
+        resampling = Resampling[self.resampling]
+        
+        with rasterio.open(list_of_images[0]) as reference:
+            location_in_img_crs = [p[0] for p in transform(
+                IO_CRS, reference.crs, [location.x], [location.y])]
+            location_in_img_pix = [
+                int(np.floor(p)) for p in
+                ~reference.transform * location_in_img_crs]
+            # the upper left corner of the tile is snapped to the pixel grid
+            # of the reference image.
+            left, top = reference.transform * [
+                location_in_img_pix[0]-half_edge,
+                location_in_img_pix[1]-half_edge]
+            native_res = reference.res
+            profile = {
+                "driver": "GTiff",
+                "height": mosaic_size,
+                "width": mosaic_size,
+                "count": len(self.band_indexes),
+                "dtype": reference.dtypes[0],
+                "crs": reference.crs,
+                "transform": Affine(native_res[0]*scale, 0, left,
+                                    0, -native_res[1]*scale, top),
+                "nodata": reference.nodata
+            }
+        fill_value = 0 if profile["nodata"] is None else profile["nodata"]
+        mosaic = np.full((profile["count"], mosaic_size, mosaic_size),
+                         fill_value, dtype=profile["dtype"])
+        covered = np.zeros((mosaic_size, mosaic_size), dtype=bool)
+        
+        # fill the mosaic until all pixels are covered
+        used_images = []
+        for image_path in list_of_images:
+            with rasterio.open(image_path) as image:
+                if _shares_grid(image, profile["crs"], native_res):
+                    placed = _place_window(image, mosaic, covered, profile,
+                                           self.band_indexes, resampling)
+                else:
+                    placed = _reproject_window(image, mosaic, covered, profile,
+                                               self.band_indexes, resampling)
+            if placed:
+                used_images.append(image_path)
+            if covered.all():
+                break
+        
+        assert len(used_images) > 0, (
+            f"None of the images covers the location {coordinatify_point(location)}.")
+        return mosaic, covered, profile, used_images
+    
+    
     def make_temp_image(self, location, image_path):
         '''
         Extract the focal tile (often partial) from a given image and store it.
@@ -139,8 +582,6 @@ class FileStitcher:
         import numpy as np
         import rasterio
 
-        IO_CRS = "epsg:4326"
-
         file_name_suffix = "_".join([
             _stringisize_point(location),
             f"{self.tile_size}px"])
@@ -187,41 +628,261 @@ class FileStitcher:
                 wdw_top_edge,
                 wdw_width,
                 wdw_height)
-            image_tile = image.read(window=wdw)
+            # only the bands of requested features are read
+            image_tile = image.read(self.band_indexes, window=wdw)
             kwargs = image.meta.copy()
             kwargs.update({
                 'height': wdw.height,
                 'width': wdw.width,
                 'transform': rasterio.windows.transform(wdw, image.transform)})
-            # store the tiles in rgb or ir image, if requested
+            # store the tiles in an image for each requested feature
             images_produced = {}
-        for profile, phot_prof in zip(["rgb", "ir"], ["RGB", "Grayscale"]):
-            if profile in self.features:
-                full_size = (image_tile.shape[1] == self.tile_size and
-                             image_tile.shape[2] == self.tile_size)
-                try:
-                    temp_image = NamedTemporaryFile(
-                        mode="w",
-                        prefix=file_name.replace("FEATURE_PLACE_HOLDER", profile),
-                        dir=".",
-                    suffix=".tif")
-                    kwargs['count'] = 3 if profile == "rgb" else 1
-                    with rasterio.open(
-                            temp_image.name, "w",
-                            photometric=phot_prof, **kwargs) as file:
-                        if profile == "rgb":
-                            file.write(image_tile[0:3])
-                        else:  # TODO: how to save as greyscale image?
-                            file.write(image_tile[3] , indexes=1)  # we only store the last layer.
-                except IOError as err:
-                    pass
-                else:
-                    images_produced[profile] = (temp_image, full_size)
+        for profile in self.features:
+            full_size = (image_tile.shape[1] == self.tile_size and
+                         image_tile.shape[2] == self.tile_size)
+            try:
+                temp_image = NamedTemporaryFile(
+                    mode="w",
+                    prefix=file_name.replace("FEATURE_PLACE_HOLDER", profile),
+                    dir=".",
+                suffix=".tif")
+                write_feature_tile(temp_image.name,
+                                   self.make_feature_tile(image_tile, profile), kwargs)
+            except IOError as err:
+                pass
+            else:
+                images_produced[profile] = (temp_image, full_size)
 
         return images_produced
 
 
+# mergeable statistics of image bands
+class BandStatistics:
+    '''
+    Running per-band mean, standard deviation, histogram and nodata
+    fraction of image tiles.
+    
+    Tiles are added with `update`, statistics of different tiles or
+    workers are combined with `merge` (Welford/Chan).
+    '''
+    def __init__(self, number_of_bands, dtype):
+        '''
+        Construct empty statistics for a number of bands of given dtype.
+        '''
+        import numpy as np
+        
+        self.count = 0
+        self.pixels = 0
+        self.nodata_pixels = 0
+        self.mean = np.zeros(number_of_bands)
+        self.m2 = np.zeros(number_of_bands)
+        self.histogram_edges = _histogram_edges(dtype)
+        self.histograms = np.zeros(
+            (number_of_bands, len(self.histogram_edges) - 1), dtype="int64")
+        return
+    
+    
+    def update(self, band_array, valid):
+        '''
+        Add the valid pixels of an array (bands, height, width).
+        '''
+        import numpy as np
+        
+        values = band_array[:, valid].astype("float64")
+        self.pixels += valid.size
+        self.nodata_pixels += valid.size - values.shape[1]
+        self.histograms += np.stack([
+            np.histogram(band, bins=self.histogram_edges)[0] for band in values])
+        if values.shape[1] > 0:
+            mean = values.mean(axis=1)
+            self.combine_moments(values.shape[1], mean,
+                                 ((values - mean[:, None])**2).sum(axis=1))
+        return
+    
+    
+    def merge(self, other):
+        '''
+        Combine other statistics (of the same bands) with these.
+        '''
+        self.pixels += other.pixels
+        self.nodata_pixels += other.nodata_pixels
+        self.histograms += other.histograms
+        if other.count > 0:
+            self.combine_moments(other.count, other.mean, other.m2)
+        return
+    
+    
+    def combine_moments(self, count, mean, m2):
+        '''
+        Add count, mean and sum of squared deviations of other values.
+        '''
+        total_count = self.count + count
+        delta = mean - self.mean
+        self.mean = self.mean + delta*count/total_count
+        self.m2 = self.m2 + m2 + delta**2*self.count*count/total_count
+        self.count = total_count
+        return
+    
+    
+    def get_std(self):
+        '''
+        Return the (population) standard deviation of each band.
+        '''
+        import numpy as np
+        
+        if self.count == 0:
+            return np.full(len(self.mean), np.nan)
+        return np.sqrt(self.m2/self.count)
+    
+    
+    def get_nodata_fraction(self):
+        '''
+        Return the fraction of pixels without data.
+        '''
+        return self.nodata_pixels/self.pixels if self.pixels > 0 else 1.
+    
+    
+    def to_dict(self):
+        '''
+        Return the statistics as json serializable dictionary.
+        '''
+        return {
+            "count": self.count,
+            "nodata_fraction": self.get_nodata_fraction(),
+            "mean": self.mean.tolist(),
+            "std": self.get_std().tolist(),
+            "histogram_edges": self.histogram_edges.tolist(),
+            "histograms": self.histograms.tolist()
+        }
+# end BandStatistics
+
+
+class ProcessPoolStitcher:
+    '''
+    Stand-in for a FileStitcher, which runs the stitching (decoding,
+    window maths, reprojection and resizing) in a process pool.
+    
+    The tiles are written by the workers into slabs of a shared memory
+    pool instead of being pickled and kept (as views) in memory (`sink`)
+    like by a stitcher with a MemorySink. The slabs in use need to be
+    released (`pop_held_slabs`) once the tiles are stored. If no slab
+    is free, tiles are pickled. Band statistics of the workers are
+    collected here.
+    '''
+    def __init__(self, tile_stitcher, process_pool, slab_pool):
+        '''
+        Construct with the stitcher, which is copied to the workers, a
+        `concurrent.futures` process pool and a pool of shared memory slabs.
+        '''
+        import copy
+        
+        self.tile_stitcher = copy.copy(tile_stitcher)
+        self.tile_stitcher.statistics = {}
+        self.tile_stitcher.set_sink(MemorySink())
+        self.process_pool = process_pool
+        self.slab_pool = slab_pool
+        self.held_slabs = []
+        
+        self.sink = MemorySink()
+        return
+    
+    
+    @property
+    def tile_sizes(self):
+        return self.tile_stitcher.tile_sizes
+    
+    
+    @property
+    def statistics(self):
+        return self.tile_stitcher.statistics
+    
+    
+    def set_tile_size(self, tile_size_in_pixels, scale_labels=None):
+        '''
+        Change the edgelength(s) (pixel) of the window(s) read around a location.
+        '''
+        self.tile_stitcher.set_tile_size(tile_size_in_pixels, scale_labels=scale_labels)
+        return
+    
+    
+    def stitch_image(self, location, list_of_images: list, file_name_prefix=None):
+        '''
+        Extract and stitch tile from image(s) in a worker process and wait
+        for it.
+        '''
+        slab_index = self.slab_pool.acquire()
+        slab_name = None if slab_index is None else self.slab_pool.get_name(slab_index)
+        try:
+            image_manipulation, shared_entries, statistics = self.process_pool.submit(
+                stitch_in_process, self.tile_stitcher, location, list_of_images,
+                file_name_prefix, slab_name).result()
+        except BaseException:
+            if slab_index is not None:
+                self.slab_pool.release(slab_index)
+            raise
+        if slab_index is not None:
+            self.held_slabs.append(slab_index)
+        
+        # tiles in the slab are viewed without copying
+        for file_name, feature, scale, shared_tile, profile in shared_entries:
+            if isinstance(shared_tile, tuple):
+                shared_tile = self.slab_pool.get_array(slab_index, shared_tile)
+            self.sink.write_tile(file_name, feature, scale, shared_tile, profile)
+        self.tile_stitcher.merge_statistics(statistics)
+        return image_manipulation
+    
+    
+    def pop_held_slabs(self):
+        '''
+        Return the indexes of the slabs holding tiles since the last call.
+        '''
+        held_slabs = self.held_slabs
+        self.held_slabs = []
+        return held_slabs
+# end ProcessPoolStitcher
+
+
+def stitch_in_process(tile_stitcher, location, list_of_images, file_name_prefix,
+                      slab_name=None):
+    '''
+    Stitch the tiles of a location with a (pickled) stitcher in a worker
+    process.
+    
+    The manipulation dictionary, the written tiles and the band statistics
+    are returned. Tiles which fit into the given shared memory slab are
+    written there and returned as handles (offset, shape, dtype).
+    '''
+    from shared_buffers import SlabWriter
+    
+    tile_stitcher.statistics = {}
+    tile_stitcher.set_sink(MemorySink())
+    image_manipulation = tile_stitcher.stitch_image(
+        location, list_of_images, file_name_prefix=file_name_prefix)
+    
+    slab_writer = None if slab_name is None else SlabWriter(slab_name)
+    shared_entries = []
+    for file_name, feature, scale, feature_tile, profile in tile_stitcher.sink.pop_entries():
+        handle = None if slab_writer is None else slab_writer.put(feature_tile)
+        shared_entries.append((file_name, feature, scale,
+                               feature_tile if handle is None else handle, profile))
+    return image_manipulation, shared_entries, tile_stitcher.statistics
+
+
 # helpers
+def _histogram_edges(dtype):
+    '''
+    Return fixed histogram bin edges for a dtype, so histograms can be merged.
+    
+    Spectral indices (floats) range from -1 to 1, integers cover their full range.
+    '''
+    import numpy as np
+    
+    if np.issubdtype(dtype, np.floating):
+        return np.linspace(-1, 1, 201)
+    dtype_info = np.iinfo(dtype)
+    return np.linspace(dtype_info.min, dtype_info.max + 1, 257)
+
+
 def _stringisize_point(shapely_point):
     '''
     Construct underscore seperated string from Point for filenames.
@@ -234,6 +895,185 @@ def _stringisize_point(shapely_point):
     return point_as_string
 
 
+def _shares_grid(rasterio_image, crs, resolution):
+    '''
+    Check if an image has the same crs and resolution as the reference
+    of a mosaic.
+    '''
+    import numpy as np
+    
+    return (rasterio_image.crs == crs and
+            np.allclose(rasterio_image.res, resolution))
+
+
+def _place_window(rasterio_image, mosaic, covered, profile, band_indexes,
+                  resampling):
+    '''
+    Copy the overlap of an image on the same grid into the mosaic.
+    
+    If the mosaic is coarser than the image, the overlap is decoded at the
+    resolution of the mosaic. Returns if any pixel was placed.
+    '''
+    import numpy as np
+    import rasterio
+    
+    dst_transform = profile["transform"]
+    scale_x = dst_transform.a/rasterio_image.res[0]
+    scale_y = -dst_transform.e/rasterio_image.res[1]
+    # offset of the mosaic origin in pixels of the image. small
+    # subpixel shifts are rounded as in `rasterio.merge`
+    col_off, row_off = [int(round(p)) for p in
+        ~rasterio_image.transform * (dst_transform.c, dst_transform.f)]
+    
+    # the overlap in image pixel coordinates
+    col_start = max(0, col_off)
+    row_start = max(0, row_off)
+    col_stop = min(rasterio_image.width,
+                   col_off + int(round(profile["width"]*scale_x)))
+    row_stop = min(rasterio_image.height,
+                   row_off + int(round(profile["height"]*scale_y)))
+    
+    # the same overlap in mosaic pixel coordinates
+    dst_slice = (slice(int(round((row_start-row_off)/scale_y)),
+                       int(round((row_stop-row_off)/scale_y))),
+                 slice(int(round((col_start-col_off)/scale_x)),
+                       int(round((col_stop-col_off)/scale_x))))
+    dst_shape = (dst_slice[0].stop - dst_slice[0].start,
+                 dst_slice[1].stop - dst_slice[1].start)
+    if min(dst_shape) <= 0:
+        return False
+    
+    wdw = rasterio.windows.Window(
+        col_start, row_start, col_stop-col_start, row_stop-row_start)
+    # with an out_shape smaller than the window gdal reads from overviews
+    image_tile = rasterio_image.read(
+        band_indexes, window=wdw, out_shape=(len(band_indexes),) + dst_shape,
+        resampling=resampling)
+    
+    valid = ~covered[dst_slice]
+    if rasterio_image.nodata is not None:
+        valid &= (image_tile != rasterio_image.nodata).any(axis=0)
+    np.copyto(mosaic[(slice(None),) + dst_slice], image_tile, where=valid)
+    covered[dst_slice] |= valid
+    return bool(valid.any())
+
+
+def _reproject_window(rasterio_image, mosaic, covered, profile, band_indexes,
+                      resampling):
+    '''
+    Reproject the overlap of an image on a different grid into the mosaic.
+    
+    The pixels with data are tracked by a reprojected mask, so pixel values
+    equal to the nodata value of the mosaic (e.g. 0) are placed as well.
+    Returns if any pixel was placed.
+    '''
+    import numpy as np
+    import rasterio
+    from rasterio.enums import Resampling
+    from rasterio.transform import array_bounds
+    from rasterio.warp import reproject
+    from rasterio.warp import transform_bounds
+    
+    # we only read the part of the image that overlaps the mosaic
+    dst_bounds = array_bounds(
+        profile["height"], profile["width"], profile["transform"])
+    src_bounds = transform_bounds(profile["crs"], rasterio_image.crs, *dst_bounds)
+    wdw = rasterio.windows.from_bounds(
+        *src_bounds, transform=rasterio_image.transform).round_offsets(
+        ).round_lengths().intersection(
+        rasterio.windows.Window(0, 0, rasterio_image.width, rasterio_image.height))
+    image_tile = rasterio_image.read(band_indexes, window=wdw)
+    # pixels are valid unless all bands hold the nodata value of the source
+    image_valid = np.ones(image_tile.shape[1:], dtype="uint8")
+    if rasterio_image.nodata is not None:
+        image_valid[(image_tile == rasterio_image.nodata).all(axis=0)] = 0
+    
+    fill_value = 0 if profile["nodata"] is None else profile["nodata"]
+    warped_tile = np.full_like(mosaic, fill_value)
+    warped_valid = np.zeros(mosaic.shape[1:], dtype="uint8")
+    warp_kwargs = {
+        "src_transform": rasterio_image.window_transform(wdw),
+        "src_crs": rasterio_image.crs,
+        "dst_transform": profile["transform"],
+        "dst_crs": profile["crs"]
+    }
+    reproject(
+        source=image_tile,
+        destination=warped_tile,
+        src_nodata=rasterio_image.nodata,
+        dst_nodata=fill_value,
+        resampling=resampling,
+        **warp_kwargs)
+    # outside of the image the mask stays 0
+    reproject(
+        source=image_valid,
+        destination=warped_valid,
+        src_nodata=0,
+        dst_nodata=0,
+        resampling=Resampling.nearest,
+        **warp_kwargs)
+    
+    valid = ~covered & (warped_valid > 0)
+    np.copyto(mosaic, warped_tile, where=valid)
+    covered |= valid
+    return bool(valid.any())
+
+
+def _check_stitch_mode_of_features(features, stitch_mode):
+    '''
+    Check that spectral indices are only requested in the `mosaic` stitch
+    mode, as the `cv2` mode reads its (float) tiles back as 8 bit images.
+    '''
+    spectral_indices = [feature for feature in features if feature in SPECTRAL_INDICES]
+    if stitch_mode != "mosaic" and len(spectral_indices) > 0:
+        raise ValueError(
+            f"The spectral indices {spectral_indices} can only be computed in the "
+            f"`mosaic` stitch mode, not in `{stitch_mode}`.")
+    return
+
+
+def _copy_resized_tile(source_path, file_path, scale, resampling):
+    '''
+    Copy a tif with height and width reduced by a factor (`scale` > 1).
+    '''
+    import rasterio
+    from rasterio.enums import Resampling
+    from rasterio.transform import Affine
+    
+    with rasterio.open(source_path) as source:
+        out_shape = (source.count,
+                     max(1, int(round(source.height/scale))),
+                     max(1, int(round(source.width/scale))))
+        # gdal decodes the tile at the reduced size
+        tile = source.read(out_shape=out_shape, resampling=Resampling[resampling])
+        profile = source.profile.copy()
+        profile.update({
+            "height": out_shape[1],
+            "width": out_shape[2],
+            "transform": source.transform * Affine.scale(
+                source.width/out_shape[2], source.height/out_shape[1])
+        })
+    write_feature_tile(file_path, tile, profile)
+    return
+
+
+def _resize_bands(band_array, edge_size, resampling):
+    '''
+    Resize all bands of an array (bands, height, width) to a square edge size.
+    '''
+    import cv2
+    import numpy as np
+    
+    interpolations = {
+        "nearest": cv2.INTER_NEAREST,
+        "average": cv2.INTER_AREA
+    }
+    interpolation = interpolations.get(resampling, cv2.INTER_LINEAR)
+    return np.stack([
+        cv2.resize(band, (edge_size, edge_size), interpolation=interpolation)
+        for band in band_array])
+
+
 def _check_if_image_has_tile_size(rasterio_image_wrapper, tile_edge_size):
     '''
     Check if an image tile has the actual tile_edge_size (as square).
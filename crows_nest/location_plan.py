@@ -0,0 +1,385 @@
+# here one can find the plan of a run, which normalizes the locations
+# and dates once, so all dataminers can share it.
+import numpy as np
+
+# width of the ids of locations, the same for lists and streams of locations
+LOCATION_ID_WIDTH = 10
+
+
+## classes ##
+class Locations:
+    '''
+    Compact container of locations (longitude, latitude) and their dates
+    backed by numpy arrays.
+    
+    Shapely points are only created when single locations are accessed
+    (indexing or iteration), slices stay containers.
+    '''
+    __slots__ = ("longitudes", "latitudes", "dates")
+    
+    def __init__(self, longitudes, latitudes, dates=None):
+        '''
+        Construct with sequences of longitudes and latitudes (and dates,
+        otherwise today is used for all).
+        '''
+        from datetime import date
+        
+        self.longitudes = np.asarray(longitudes, dtype="float64")
+        self.latitudes = np.asarray(latitudes, dtype="float64")
+        assert self.longitudes.shape == self.latitudes.shape, (
+            f"The lists for longitudes ({len(self.longitudes)}) and "
+            f"latitudes ({len(self.latitudes)}) have unequal length. Please adjust.")
+        if dates is None:
+            self.dates = np.full(len(self.longitudes), np.datetime64(date.today(), "D"))
+        else:
+            self.dates = _to_datetime64(dates)
+            assert len(self.dates) == len(self.longitudes), (
+                f"The length of the list of locations ({len(self.longitudes)})"
+                f" does not align with the one of dates ({len(self.dates)})\n"
+                f"Please check and try again.")
+        return
+    
+    
+    def __len__(self):
+        return len(self.longitudes)
+    
+    
+    def __getitem__(self, index):
+        '''
+        Return the point of an index or a container for a slice/index array.
+        '''
+        from shapely.geometry import Point
+        
+        if isinstance(index, (int, np.integer)):
+            return Point(self.longitudes[index], self.latitudes[index])
+        return Locations(self.longitudes[index], self.latitudes[index], self.dates[index])
+    
+    
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+    
+    
+    @property
+    def coordinates(self):
+        '''
+        Return the coordinates as array of (longitude, latitude) rows.
+        '''
+        return np.column_stack([self.longitudes, self.latitudes])
+    
+    
+    def get_date(self, index):
+        '''
+        Return the date of a location as `datetime.date`.
+        '''
+        return self.dates[index].astype(object)
+    
+    
+    @classmethod
+    def from_points(cls, points, dates=None):
+        '''
+        Construct from shapely points (and dates).
+        '''
+        coordinates = np.array([(point.x, point.y) for point in points],
+                               dtype="float64").reshape(-1, 2)
+        return cls(coordinates[:, 0], coordinates[:, 1], dates)
+    
+    
+    @classmethod
+    def from_dataframe(cls, data_frame, longitude="longitude", latitude="latitude",
+                       date=None):
+        '''
+        Construct from columns of a pandas data frame (`date` is the name of
+        an optional date column).
+        
+        For GeoDataFrames without coordinate columns the point geometries are
+        used.
+        '''
+        if longitude not in data_frame and hasattr(data_frame, "geometry"):
+            longitudes = data_frame.geometry.x.to_numpy()
+            latitudes = data_frame.geometry.y.to_numpy()
+        else:
+            longitudes = data_frame[longitude].to_numpy()
+            latitudes = data_frame[latitude].to_numpy()
+        dates = None if date is None else data_frame[date].to_numpy()
+        return cls(longitudes, latitudes, dates)
+    
+    
+    @classmethod
+    def from_input(cls, locations, dates=None):
+        '''
+        Return a container of the given locations (shapely points or a
+        container) and dates, which replace the ones of a container.
+        '''
+        if isinstance(locations, cls):
+            if dates is None:
+                return locations
+            return cls(locations.longitudes, locations.latitudes, dates)
+        return cls.from_points(locations, dates)
+# end Locations
+
+
+class LocationPlan:
+    '''
+    Normalized locations and dates of a run.
+    
+    Each location has a stable id derived from its position in the
+    input, so the outputs of different databases line up. Repeated
+    pairs of location and date (same key) can be processed once (if
+    deduplicated) and the locations are processed in a spatial (z-)order,
+    so neighbours (sharing raw tiles) follow each other.
+    
+    A plan can also cover a chunk of a `LocationStream`, then its indices
+    start at the `offset` of the chunk and the ids do not depend on the
+    (unknown) total number of locations.
+    '''
+    def __init__(self, locations, dates=None, key_precision=7, silent=True, offset=None):
+        '''
+        Construct with a `Locations` container or a list of shapely points
+        (and dates).
+        
+        Locations with equal coordinates up to `key_precision` decimals and
+        equal dates share a key. `offset` is the index of the first location
+        of a chunk (in a stream).
+        '''
+        if dates is None and not isinstance(locations, Locations) and not silent : print(
+            "As no dates were specified the most recent data will be fetched.")
+        self.locations = Locations.from_input(locations, dates)
+        self.size = len(self.locations)
+        self.key_precision = key_precision
+        # chunks of a stream do not know the total number of locations
+        self.offset = 0 if offset is None else offset
+        self.total_number = self.size if offset is None else None
+        
+        # the first location of each key is processed
+        key_array = np.column_stack([
+            np.round(self.locations.coordinates, key_precision),
+            self.locations.dates.astype("int64").astype("float64")])
+        _, first_indices, self.key_indices = np.unique(
+            key_array, axis=0, return_index=True, return_inverse=True)
+        self.key_indices = self.key_indices.reshape(-1)
+        self.unique_indices = np.sort(first_indices)
+        self.number_of_duplicates = self.size - len(self.unique_indices)
+        self.first_indices = first_indices
+        
+        # spatial order of all and of the unique locations
+        morton_codes = _morton_codes(self.locations.coordinates)
+        self.order = np.argsort(morton_codes, kind="stable")
+        self.unique_order = self.unique_indices[
+            np.argsort(morton_codes[self.unique_indices], kind="stable")]
+        if not silent and self.number_of_duplicates > 0 : print(
+            f"{self.number_of_duplicates} repeated location(s) were found.")
+        return
+    
+    
+    def __len__(self):
+        return self.size
+    
+    
+    @classmethod
+    def from_input(cls, locations, dates=None, silent=True):
+        '''
+        Return the plan of the given locations and dates (or the plan itself
+        if one is given).
+        '''
+        if isinstance(locations, cls):
+            return locations
+        return cls(locations, dates, silent=silent)
+    
+    
+    def get_task(self, index):
+        '''
+        Return the location (shapely point) and date of an index.
+        '''
+        index = index - self.offset
+        return self.locations[index], self.locations.get_date(index)
+    
+    
+    def get_location_id(self, index):
+        '''
+        Return the stable id of a location.
+        '''
+        return make_location_id(index)
+    
+    
+    def get_first_index(self, index):
+        '''
+        Return the index of the location processed for the key of an index.
+        '''
+        return self.offset + int(self.first_indices[self.key_indices[index - self.offset]])
+    
+    
+    def iter_tasks(self, spatial_order=True, deduplicate=False):
+        '''
+        Yield index, location and date of the locations to process.
+        
+        With `deduplicate` only the first of repeated locations is given,
+        without `spatial_order` the locations are given in input order.
+        '''
+        if spatial_order:
+            indices = self.unique_order if deduplicate else self.order
+        else:
+            indices = self.unique_indices if deduplicate else range(self.size)
+        for idx in indices:
+            yield (int(idx) + self.offset,) + self.get_task(int(idx) + self.offset)
+# end LocationPlan
+
+
+class LocationStream:
+    '''
+    Locations of unknown number (e.g. read from a file or a generator),
+    which are planned and processed chunk by chunk.
+    
+    Iterating yields a `LocationPlan` for each chunk, so only the
+    locations of one chunk are held in memory. The indices (and ids)
+    continue over the chunks, repeated locations are only recognized
+    within a chunk.
+    '''
+    def __init__(self, read_chunks, total_number=None, reiterable=True, key_precision=7,
+                 silent=True):
+        '''
+        Construct with a function returning an iterator of the chunks
+        (`Locations` containers or plans) for each pass over the stream.
+        
+        `total_number` is the number of locations, if known. Streams that
+        are not `reiterable` can only be passed over once.
+        '''
+        self.read_chunks = read_chunks
+        self.total_number = total_number
+        self.reiterable = reiterable
+        self.key_precision = key_precision
+        self.silent = silent
+        return
+    
+    
+    def __iter__(self):
+        offset = 0
+        for chunk in self.read_chunks():
+            if isinstance(chunk, LocationPlan):
+                yield chunk
+                continue
+            plan = LocationPlan(chunk, key_precision=self.key_precision,
+                                silent=self.silent, offset=offset)
+            offset += plan.size
+            yield plan
+    
+    
+    def iter_tasks(self, spatial_order=True, deduplicate=False):
+        '''
+        Yield index, location and date of the locations to process, chunk by
+        chunk (see `LocationPlan.iter_tasks`).
+        '''
+        for plan in self:
+            yield from plan.iter_tasks(spatial_order, deduplicate)
+    
+    
+    @classmethod
+    def from_input(cls, locations, dates=None, chunk_size=10000, silent=True):
+        '''
+        Return a stream of the given locations and dates: a stream itself,
+        a single plan of locations of known length (a list, container or
+        plan) or chunks of other iterables.
+        '''
+        if isinstance(locations, cls):
+            return locations
+        if isinstance(locations, LocationPlan) or hasattr(locations, "__len__"):
+            plan = LocationPlan.from_input(locations, dates, silent=silent)
+            return cls(lambda: iter([plan]), total_number=plan.size, silent=silent)
+        return cls.from_iterable(locations, dates, chunk_size=chunk_size, silent=silent)
+    
+    
+    @classmethod
+    def from_iterable(cls, locations, dates=None, chunk_size=10000, silent=True):
+        '''
+        Construct from an iterable of shapely points (and one of dates), e.g.
+        a generator. Such a stream can only be iterated once.
+        '''
+        from itertools import islice
+        
+        def read_chunks():
+            points = iter(locations)
+            dates_given = None if dates is None else iter(dates)
+            while True:
+                chunk_points = list(islice(points, chunk_size))
+                if len(chunk_points) == 0:
+                    return
+                chunk_dates = None
+                if dates_given is not None:
+                    chunk_dates = list(islice(dates_given, len(chunk_points)))
+                yield Locations.from_points(chunk_points, chunk_dates)
+        
+        if dates is None and not silent : print(
+            "As no dates were specified the most recent data will be fetched.")
+        return cls(read_chunks, reiterable=False, silent=silent)
+    
+    
+    @classmethod
+    def from_file(cls, file_path, longitude="longitude", latitude="latitude", date=None,
+                  chunk_size=100000, silent=True):
+        '''
+        Construct from the columns of a CSV or Parquet file, which is read
+        in chunks of `chunk_size` rows (`date` is the name of an optional
+        date column).
+        '''
+        columns = [longitude, latitude] + ([] if date is None else [date])
+        if str(file_path).endswith((".parquet", ".pq")):
+            def read_chunks():
+                import pyarrow.parquet as pq
+                
+                parquet_file = pq.ParquetFile(file_path)
+                for batch in parquet_file.iter_batches(batch_size=chunk_size, columns=columns):
+                    yield Locations.from_dataframe(batch.to_pandas(), longitude, latitude, date)
+        else:
+            def read_chunks():
+                import pandas as pd
+                
+                with pd.read_csv(file_path, usecols=columns, chunksize=chunk_size) as reader:
+                    for data_frame in reader:
+                        yield Locations.from_dataframe(data_frame, longitude, latitude, date)
+        
+        if date is None and not silent : print(
+            "As no dates were specified the most recent data will be fetched.")
+        return cls(read_chunks, silent=silent)
+# end LocationStream
+
+
+def make_location_id(index):
+    '''
+    Return the id of a location given its index. The ids have a fixed
+    width, so a location gets the same id in a list or a stream.
+    '''
+    return f"loc_{str(index+1).zfill(LOCATION_ID_WIDTH)}"
+
+
+# helpers
+def _morton_codes(coordinates, bits=16):
+    '''
+    Compute the z-order (morton) code of each coordinate pair, the bits of
+    both quantized coordinates are interleaved.
+    
+    Both axes are quantized with the same step, to keep the aspect ratio.
+    '''
+    if len(coordinates) == 0:
+        return np.zeros(0, dtype="uint64")
+    minimum = coordinates.min(axis=0)
+    extent = max((coordinates.max(axis=0) - minimum).max(), 1e-12)
+    quantized = ((coordinates - minimum)/extent*(2**bits - 1)).astype("uint64")
+    codes = np.zeros(len(coordinates), dtype="uint64")
+    for bit in range(bits):
+        for axis in range(2):
+            codes |= ((quantized[:, axis] >> np.uint64(bit)) & np.uint64(1)) << np.uint64(2*bit + axis)
+    return codes
+
+
+def _to_datetime64(dates):
+    '''
+    Convert dates (date objects, strings or datetime64) to a day array.
+    '''
+    from datetime import date
+    from datetime import datetime
+    
+    dates = np.asarray(dates)
+    if dates.dtype == object:
+        dates = np.array([d.date() if isinstance(d, datetime) else d for d in dates],
+                         dtype="datetime64[D]")
+    return dates.astype("datetime64[D]")
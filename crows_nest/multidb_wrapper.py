@@ -10,7 +10,7 @@ from datetime import date
 from database_classes import SpatialData
 from utils import set_directory
 from utils import set_locations
-from utils import check_locations_and_dates
+from location_plan import LocationStream
 
 # core class
 class GetMultiDBData:
@@ -64,16 +64,187 @@ class GetMultiDBData:
         return
 
     # run the datamining on provided locations and dates
-    def run(self, locations, dates=None):
+    def run(self, locations, dates=None, concurrent=False, total_workers=8,
+            miner_workers=None, raise_errors=True):
         '''
         Retrieve data from all requested databases for a given set of
         locations (and corresponding dates)
+        
+        With `concurrent` all dataminers run at the same time, each with a
+        thread pool. At most `total_workers` threads of all dataminers run
+        locations at once (workers freed by one dataminer are used by the
+        others), `miner_workers` (dictionary by index or database of the
+        dataminers) can limit single ones. A dictionary with the outcome
+        (`database`, `error` or None and `duration` in s) of each dataminer
+        by its index is returned.
+        
+        With `raise_errors` the first error of a dataminer is raised (after
+        all concurrent ones finished), otherwise the failure of one does not
+        stop the others.
+        
+        Locations and dates are normalized once to a `LocationPlan`, which
+        all dataminers share (their outputs line up by the location ids).
+        Streams of locations (`LocationStream`) are read once and their
+        chunks are handed to all (concurrent) dataminers.
         '''
+        from concurrent.futures import ThreadPoolExecutor
+        import threading
+        
         # for each location we should have a respective date
-        dates = check_locations_and_dates(locations, dates)
-        for dataminer in self.dataminers:
-            dataminer.run(locations, dates=dates)  # run the mining on each database. 
-        return
+        location_stream = LocationStream.from_input(locations, dates, silent=self.silent)
+        assert location_stream.reiterable or concurrent or len(self.dataminers) < 2, (
+            "A stream of locations, that can only be read once, needs the "
+            "dataminers to run concurrently.")
+        if location_stream.total_number is not None:
+            location_stream = next(iter(location_stream))
+        
+        if not concurrent:
+            outcomes = {}
+            for miner_index, dataminer in enumerate(self.dataminers):
+                # run the mining on each database.
+                outcomes[miner_index] = _run_dataminer(
+                    dataminer, location_stream, executor="serial", workers=None)
+                if raise_errors and outcomes[miner_index]["error"] is not None:
+                    raise outcomes[miner_index]["error"]
+        else:
+            # the chunks of a stream are read once for all dataminers
+            miner_streams = [location_stream]*len(self.dataminers)
+            stream_ends = [None]*len(self.dataminers)
+            if isinstance(location_stream, LocationStream):
+                miner_streams, stream_ends = _fan_out_stream(
+                    location_stream, len(self.dataminers), silent=self.silent)
+            
+            # the thread budget is shared by all dataminers, each can use all
+            # of it (up to its own limit)
+            miner_workers = {} if miner_workers is None else miner_workers
+            worker_budget = threading.BoundedSemaphore(total_workers)
+            with ThreadPoolExecutor(max_workers=max(len(self.dataminers), 1)) as pool:
+                futures = {
+                    miner_index: pool.submit(
+                        _run_dataminer, dataminer, miner_stream, executor="threads",
+                        workers=min(total_workers, miner_workers.get(
+                            miner_index, miner_workers.get(dataminer.DATABASE, total_workers))),
+                        stream_end=stream_end, worker_budget=worker_budget)
+                    for miner_index, (dataminer, miner_stream, stream_end)
+                    in enumerate(zip(self.dataminers, miner_streams, stream_ends))}
+                outcomes = {miner_index: future.result()
+                            for miner_index, future in futures.items()}
+        
+        if not self.silent:
+            for outcome in outcomes.values():
+                print(f"`{outcome['database']}` " + (
+                    f"finished in {outcome['duration']:.1f} s." if outcome["error"] is None
+                    else f"failed with: {outcome['error']}"))
+        if raise_errors:
+            for outcome in outcomes.values():
+                if outcome["error"] is not None:
+                    raise outcome["error"]
+        return outcomes
+    
+    # estimate the cost of a run on all databases
+    def plan(self, locations, dates=None, **plan_kwargs):
+        '''
+        Report the cost of a run on all databases without fetching data (see
+        `SpatialData.plan` for the arguments).
+        
+        A dictionary with the report of each dataminer by its index is
+        returned.
+        '''
+        # all dataminers plan the same (normalized) locations
+        location_stream = LocationStream.from_input(locations, dates, silent=self.silent)
+        assert location_stream.reiterable or len(self.dataminers) < 2, (
+            "A stream of locations, that can only be read once, cannot be "
+            "planned for multiple dataminers.")
+        if location_stream.total_number is not None:
+            location_stream = next(iter(location_stream))
+        
+        reports = {miner_index: dataminer.plan(location_stream, **plan_kwargs)
+                   for miner_index, dataminer in enumerate(self.dataminers)}
+        if not self.silent:
+            download_bytes = sum(report["download_bytes"] for report in reports.values())
+            duration = sum(report["estimated_duration"] for report in reports.values())
+            print(f"All databases: {download_bytes/1e6:.1f} MB to download, estimated "
+                  f"duration {duration/60:.1f} min (if run one after another).")
+        return reports
 
 
+# helpers
+def _run_dataminer(dataminer, plan, executor="serial", workers=None, stream_end=None,
+                   worker_budget=None):
+    '''
+    Run a dataminer and return its outcome (database, error and duration),
+    so the failure of one does not stop the others.
+    
+    `stream_end` is set when the dataminer stops reading its stream, the
+    `worker_budget` is passed on to its run.
+    '''
+    import time
+    
+    start = time.perf_counter()
+    try:
+        dataminer.run(plan, executor=executor, workers=workers,
+                      worker_budget=worker_budget)
+    except Exception as err:
+        error = err
+    else:
+        error = None
+    finally:
+        if stream_end is not None:
+            stream_end.set()
+    return {"database": dataminer.DATABASE, "error": error,
+            "duration": time.perf_counter() - start}
+
 
+def _fan_out_stream(location_stream, number_of_streams, queue_size=2, silent=True):
+    '''
+    Read the chunks of a stream once (in a thread) and return a stream
+    of the same chunks for each consumer and the events, which mark that
+    a consumer stopped reading.
+    
+    At most `queue_size` chunks wait for each consumer, so a slow one
+    holds back the reading (and memory stays bounded).
+    '''
+    import queue
+    import threading
+    
+    chunk_queues = [queue.Queue(maxsize=queue_size) for _ in range(number_of_streams)]
+    stream_ends = [threading.Event() for _ in range(number_of_streams)]
+    read_errors = []
+    
+    def put_chunk(stream_index, plan):
+        # consumers that stopped are skipped instead of blocking the others
+        while not stream_ends[stream_index].is_set():
+            try:
+                chunk_queues[stream_index].put(plan, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+    
+    def read_stream():
+        try:
+            for plan in location_stream:
+                for stream_index in range(number_of_streams):
+                    put_chunk(stream_index, plan)
+        except Exception as err:
+            read_errors.append(err)
+        finally:
+            for stream_index in range(number_of_streams):
+                put_chunk(stream_index, None)
+    
+    def make_read_chunks(stream_index):
+        def read_chunks():
+            while True:
+                plan = chunk_queues[stream_index].get()
+                if plan is None:
+                    break
+                yield plan
+            if len(read_errors) > 0:
+                raise RuntimeError(
+                    f"The locations could not be read: {read_errors[0]!r}") from read_errors[0]
+        return read_chunks
+    
+    threading.Thread(target=read_stream, name="location-reader", daemon=True).start()
+    miner_streams = [LocationStream(make_read_chunks(stream_index), reiterable=False,
+                                    silent=silent)
+                     for stream_index in range(number_of_streams)]
+    return miner_streams, stream_ends
@@ -2,19 +2,19 @@
 # it uses the NAIP western europe Azure blob storage.
 
 ## package imports ##
-import rioxarray
-import dask
 from datetime import date
 from dateutil import parser
 import numpy as np
 import os
 import pickle
-import rtree
 
 ## local imports ##
 from utils import coordinatify_point
 from utils import download_to_path
+from utils import find_csv_rows
 from utils import make_csv_path
+from utils import make_fan_out_path
+from utils import reset_made_directories
 from utils import retrieve_image_info
 from utils import set_directory
 from utils import write_csv_row
@@ -22,10 +22,25 @@ from database_classes import SpatialData
 from database_classes import MetAssembler
 
 from image_manipulation import FileStitcher
+from location_plan import LocationStream
+from location_plan import make_location_id
+from output_sinks import make_sink
+from output_sinks import MemorySink
+from output_sinks import SynchronizedSink
+from run_metrics import time_stage
 from reader import LocalReader
 from reader import RemoteReader
 
-from data import cat
+from data import get_catalog
+
+# edgelength (pixel) of the thumbnails in preview mode
+PREVIEW_SIZE = 64
+
+# the ways how the output files are named: by a key of their content
+# (stable over runs) or by the date of the run and index of the location
+FILE_NAMINGS = ["content", "index"]
+# seconds between the checks, if tiles reserved by another worker are released
+RESERVATION_POLL_INTERVAL = 0.05
 
 
 ## the classes ##
@@ -38,7 +53,11 @@ class NAIPData(SpatialData):
     
     def __init__(self, destination_path=None, remote_url=None, features=[],
                  source_path=None, copy_local=True, extend_local_cache=False,
-                 silent=False, tile_size=100, date_given=None):
+                 silent=False, tile_size=100, date_given=None, stitch_mode="mosaic",
+                 pixel_size=None, preview=False, time_series=False,
+                 output_format="geotiff", compression=None, shard_size=None,
+                 file_naming="content", fan_out_levels=0):
+        import threading
         from utils import set_gdal_environments
         
         self.DATABASE = "NAIP western europe Azure"
@@ -52,9 +71,41 @@ class NAIPData(SpatialData):
         # remember, if db index was already fetched
         self.prepared = False
         
-        # define tile metrics and init the stitcher.
+        # define tile metrics and init the stitcher. a list of tile sizes
+        # produces multiple scales from one read. tiles can be stored
+        # with less pixels than read (`pixel_size`), which is decoded from
+        # overviews. the preview mode produces small thumbnails for QA.
         self.tile_size = tile_size
-        self.tile_stitcher = FileStitcher(tile_size, features, silent=self.silent)
+        self.pixel_size = PREVIEW_SIZE if preview else pixel_size
+        self.tile_stitcher = FileStitcher(tile_size, features, silent=self.silent,
+                                          stitch_mode=stitch_mode,
+                                          output_size=self.pixel_size,
+                                          resampling="nearest" if preview else "average")
+        self.set_metrics(self.metrics)
+        
+        # in time series mode all acquisitions covering a location are
+        # extracted instead of the one closest to the requested date
+        self.time_series = time_series
+        
+        # tiles can be stored as tif files, in one chunked array store
+        # (zarr/hdf5) or in tar shards, which is set up in `prepare`
+        self.output_format = output_format
+        self.compression = compression
+        self.shard_size = shard_size
+        
+        # content keyed file names let later runs skip existing tiles
+        if file_naming not in FILE_NAMINGS:
+            raise RuntimeError(
+                f"Attention: File naming `{file_naming}` is not "
+                f"implemented. Use one of those: {FILE_NAMINGS}")
+        self.file_naming = file_naming
+        # the file names of tiles being made, reserved by the worker making
+        # them (see `reserve_tiles`), are shared by all worker copies
+        self.tile_reservations = {}
+        self.reservation_lock = threading.Lock()
+        # the files of a feature can be spread over `fan_out_levels` levels
+        # of hash named directories (256 each), instead of one directory
+        self.fan_out_levels = fan_out_levels
         return
     
     # we do not use authenticate
@@ -85,22 +136,100 @@ class NAIPData(SpatialData):
             self.csv_index_files[feature] = self.initialize_csvfile(
                 feature_header_dict, database_feature=feature)
         
+        # the sink storing the tiles in the database directory
+        self.tile_sink = make_sink(self.output_format,
+                                   self.datasource.destination.destination_dir,
+                                   compression=self.compression,
+                                   shard_size=self.shard_size, silent=self.silent)
+        self.tile_stitcher.set_sink(self.tile_sink)
+        
         # download/copy tile indices which are 3 files as in self.index_files
         self.datasource.store_index_files()
+        self.load_tile_index()
+        
+        # standardize pixels/m within date-resolution tuple
+        if not hasattr(self, "tile_sizes_dict"):
+            self.get_tile_sizes_dict()
+        return
+    
+    
+    def prepare_index(self):
+        '''
+        Fetch (if needed) and load the tile index and standardize the tile
+        sizes, without setting up the csv files or the sink (e.g. for tiles
+        which are not stored).
+        '''
+        if getattr(self, "index_pid", None) != os.getpid():
+            # the index files are fetched, unless a run prepared them already
+            if not self.prepared:
+                self.datasource.store_index_files()
+            self.load_tile_index()
+        if not hasattr(self, "tile_sizes_dict"):
+            self.get_tile_sizes_dict()
+        return
+    
+    
+    def load_tile_index(self):
+        '''
+        Load the tile index and its rtree from the index files.
+        
+        The open rtree handle can neither be pickled nor shared by forked
+        processes, so each process loads its own (see `__getstate__`). The
+        threads sharing a handle query it one after another.
+        '''
+        import rtree
+        import threading
         
         # load index_files (taken from #REF01)
         index_base_path = os.path.join(self.datasource.destination.destination_dir, "index")
         self.tile_rtree = rtree.index.Index(
             os.path.join(index_base_path, "tile_index"))
-        self.tile_index = pickle.load(
-            open(os.path.join(index_base_path, "tiles.p"), "rb"))
+        with open(os.path.join(index_base_path, "tiles.p"), "rb") as index_file:
+            self.tile_index = pickle.load(index_file)
+        self.index_pid = os.getpid()
+        self.index_lock = threading.Lock()
+        return
+    
+    
+    def __getstate__(self):
+        '''
+        Drop the tile index and the catalog entries when pickled (e.g. for
+        loader workers), they are reloaded in the receiving process.
+        '''
+        state = self.__dict__.copy()
+        for attribute in ["tile_rtree", "tile_index", "index_pid", "index_lock", "cat",
+                          "remote_function", "sink_lock", "reservation_manager"]:
+            state.pop(attribute, None)
+        # the reservations are only shared with processes through a manager
+        if getattr(self, "reservation_manager", None) is None:
+            state.pop("reservation_lock", None)
+            state["tile_reservations"] = {}
+        return state
+    
+    
+    def __setstate__(self, state):
+        '''
+        Restore a pickled dataminer, the tile index is loaded lazily.
+        '''
+        import threading
         
-        # standardize pixels/m within date-resolution tuple
-        if not hasattr(self, "tile_sizes_dict"):
-            self.get_tile_sizes_dict()
+        self.__dict__.update(state)
+        if "reservation_lock" not in state:
+            self.reservation_lock = threading.Lock()
+        self.load_catalog()
+        self.remote_function = get_catalog()[self.db_name]
         return
     
     
+    def get_tile_sizes(self):
+        '''
+        Return the tile size(s) in metres as list.
+        '''
+        if isinstance(self.tile_size, (list, tuple)):
+            return list(self.tile_size)
+        return [self.tile_size]
+    
+    
     def get_tile_sizes_dict(self):
         '''
         Standardize the pixels to take per physical distance unit (e.g. m) within a data-resoultion tuple.
@@ -122,7 +251,7 @@ class NAIPData(SpatialData):
         #     to calculate the numbers of pixels per tile (averaged between
         #     height and width).
         self.tile_sizes_dict = _compute_tile_pixel_dict(
-            self.tile_size, self.tile_index, resolutions_and_years, self.datasource)
+            self.get_tile_sizes(), self.tile_index, resolutions_and_years, self.datasource)
 
         if not self.silent:
             print(
@@ -130,8 +259,8 @@ class NAIPData(SpatialData):
                 "tile dimension. For different resolutions and "
                 "years, this corresponds to the following sizes "
                 "in pixels:")
-            for ((r, y), size) in self.tile_sizes_dict.items():
-                print(f"    - {y.year} ({r} cm): {size} px")
+            for ((r, y), sizes) in self.tile_sizes_dict.items():
+                print(f"    - {y.year} ({r} cm): {', '.join(f'{s} px' for s in sizes)}")
         return
     
     
@@ -143,10 +272,34 @@ class NAIPData(SpatialData):
         if not self.prepared:
             self.prepare()
             self.prepared = True
-        
-        # get tiles with overlap
-        rel_tile_paths = _select_intersected_tiles(location, date,
-                self.tile_rtree, self.tile_index)
+        # unpickled or forked dataminers need their own index handles
+        elif getattr(self, "index_pid", None) != os.getpid():
+            self.load_tile_index()
+        return self.select_tiles(location, date)
+    
+    
+    def build_dry_query(self, location, date=None):
+        '''
+        Build the query of a location with the tile index only, neither the
+        csv files nor the sink are set up (see `plan`).
+        '''
+        if getattr(self, "index_pid", None) != os.getpid():
+            # the index files are fetched, unless a run prepared them already
+            if not self.prepared:
+                self.datasource.store_index_files()
+            self.load_tile_index()
+        return self.select_tiles(location, date)
+    
+    
+    def select_tiles(self, location, date=None):
+        '''
+        Return the relative paths of the tiles intersecting a location (for
+        the date) from the loaded tile index.
+        '''
+        # get tiles with overlap, the rtree is not thread-safe
+        with self.index_lock, time_stage(self.metrics, "index_lookup"):
+            rel_tile_paths = _select_intersected_tiles(location, date,
+                    self.tile_rtree, self.tile_index, no_date_filter=self.time_series)
         return rel_tile_paths
     
     
@@ -168,21 +321,500 @@ class NAIPData(SpatialData):
     
     
     # download the data
-    def get_data(self, build_query, file_name, location, date_given=None):
+    def run_location(self, idx, location, dt):
+        '''
+        Query, request and store the data for one location, the file name
+        is derived from the query.
+        '''
+        build_query = self.build_query(location, dt)
+        file_name = self.make_file_name(idx, self.size, location, build_query)
+        return self.get_data(build_query, file_name, location, date_given=dt,
+                             location_id=make_location_id(idx))
+    
+    
+    def get_data(self, build_query, file_name, location, date_given=None,
+                 location_id=None):
         '''
-        Download the data for the NAIP query.
+        Download the data for the NAIP query. The `location_id` is noted in
+        the metadata rows of the tiles.
+        
+        `"skipped"` is returned, if the tiles were stored already. Their
+        rows are written for the location nonetheless.
         '''
         # account for not given date
         if date_given is None : date_given = date.today()
-
-        rd_tuple = _get_resolution_and_date(build_query[0])  # TODO is this actually right to do?
         
+        # a worker making the same tiles (e.g. for a repeated location) is
+        # waited for, instead of making them twice
+        while not self.reserve_tiles(file_name):
+            pass
+        try:
+            # tiles with the same content key were stored by a former run or
+            # another location
+            if self.has_tiles(build_query, file_name):
+                if not self.silent : print(
+                    f"The tiles for location {coordinatify_point(location)} exist already.")
+                self.document_stored_tiles(build_query, file_name, location, date_given,
+                                           location_id)
+                return "skipped"
+            
+            # first all tiles are fetched, also for all dates in time series mode
+            raw_file_names = self.fetch_tiles(build_query, location)
+            self.record_state("fetched")
+            
+            # each acquisition date is stitched on its own and stored in dated files
+            for file_suffix, queries, raw_files in self.group_acquisitions(
+                    build_query, raw_file_names):
+                self.stitch_tiles(queries, raw_files, f"{file_name}{file_suffix}",
+                                  location, date_given, location_id=location_id)
+        finally:
+            self.release_tiles(file_name)
+        return
+    
+    
+    def reserve_tiles(self, file_name, wait=True):
+        '''
+        Reserve the tiles of a file name before they are fetched, so
+        concurrent workers do not make the same tiles twice.
+        
+        True is returned, if the tiles were reserved. Otherwise another
+        worker holds them and it is waited until they are released (if
+        `wait`).
+        '''
+        import time
+        
+        with self.reservation_lock:
+            if file_name not in self.tile_reservations:
+                self.tile_reservations[file_name] = os.getpid()
+                return True
+        # the reservations may be shared with other processes, so they are polled
+        while wait and file_name in self.tile_reservations:
+            time.sleep(RESERVATION_POLL_INTERVAL)
+        return False
+    
+    
+    def release_tiles(self, file_name=None):
+        '''
+        Release the reserved tiles of a file name (all if None), so waiting
+        workers continue.
+        '''
+        with self.reservation_lock:
+            if file_name is None:
+                self.tile_reservations.clear()
+            else:
+                self.tile_reservations.pop(file_name, None)
+        return
+    
+    
+    def prepare_workers(self, executor):
+        '''
+        Load the index before the workers start. Threads share the sink
+        through a lock, while processes can only write tif files. Processes
+        share the reserved tiles through a manager.
+        '''
+        import multiprocessing
+        import threading
+        
+        if executor == "processes" and self.output_format != "geotiff":
+            raise ValueError(
+                f"The output format `{self.output_format}` cannot be written by "
+                "multiple processes. Use threads or the `geotiff` format.")
+        if not self.prepared:
+            self.prepare()
+            self.prepared = True
+        self.sink_lock = threading.Lock()
+        if executor == "processes":
+            self.reservation_manager = multiprocessing.Manager()
+            self.tile_reservations = self.reservation_manager.dict()
+            self.reservation_lock = self.reservation_manager.Lock()
+        return
+    
+    
+    def set_metrics(self, metrics):
+        '''
+        Collect the metrics of the dataminer and its stitcher in the given ones.
+        '''
+        super().set_metrics(metrics)
+        self.tile_stitcher.metrics = metrics
+        return
+    
+    
+    def make_worker(self):
+        '''
+        Return a copy of the dataminer with its own stitcher and index handle.
+        '''
+        import copy
+        
+        worker = copy.copy(self)
+        worker.tile_stitcher = copy.copy(self.tile_stitcher)
+        worker.tile_stitcher.statistics = {}
+        # copies are made through `__getstate__`, the reservations are shared
+        worker.tile_reservations = self.tile_reservations
+        worker.reservation_lock = self.reservation_lock
+        if getattr(self, "sink_lock", None) is not None:
+            # the csv index files are written with the same lock
+            worker.sink_lock = self.sink_lock
+            worker.tile_sink = SynchronizedSink(self.tile_sink, self.sink_lock)
+        worker.tile_stitcher.set_sink(worker.tile_sink)
+        worker.load_tile_index()
+        return worker
+    
+    
+    def export_worker_results(self):
+        '''
+        Return the band statistics of the tiles since the last export.
+        '''
+        statistics = self.tile_stitcher.statistics
+        self.tile_stitcher.statistics = {}
+        return statistics
+    
+    
+    def merge_worker_results(self, worker_results):
+        '''
+        Merge the band statistics of a worker.
+        '''
+        self.tile_stitcher.merge_statistics(worker_results)
+        return
+    
+    
+    def run_pipeline(self, locations, dates=None, fetch_workers=4, stitch_workers=2,
+                     queue_size=8, stitch_processes=None, shared_slabs=None,
+                     progress_interval=None, deduplicate=False):
+        '''
+        Download, stitch and store the tiles for given locations in
+        overlapping stages.
+        
+        `fetch_workers` threads download raw tiles, `stitch_workers` threads
+        stitch them in memory and a single writer stores the tiles and
+        their metadata in the order of the locations. At most `queue_size`
+        locations wait in front of each stage.
+        
+        With `stitch_processes` the stitching runs in a pool of as many
+        processes instead of threads (for CPU bound decoding). The tiles are
+        handed back in `shared_slabs` recycled shared memory slabs.
+        
+        Metrics of the stages are exported as in `run` (every
+        `progress_interval` seconds a progress line is printed), repeated
+        locations are only processed once with `deduplicate`.
+        '''
+        import copy
+        import threading
+        from concurrent.futures import ProcessPoolExecutor
+        from image_manipulation import ProcessPoolStitcher
+        from pipeline import PipelineStage
+        from pipeline import StagedPipeline
+        from run_metrics import RunMetrics
+        from shared_buffers import SharedSlabPool
+        
+        self.authenticate()
+        self.set_metrics(RunMetrics(progress_interval))
+        # directories removed since a former run are made again
+        reset_made_directories()
+        plan = LocationStream.from_input(locations, dates, silent=self.silent)
+        size = self.size = plan.total_number
+        # the index needs to be loaded before the workers start
+        if not self.prepared:
+            self.prepare()
+            self.prepared = True
+        
+        # written, skipped and repeated locations are done (for the progress)
+        done_locations = [0]
+        progress_lock = threading.Lock()
+        def conclude_locations(number):
+            with progress_lock:
+                done_locations[0] += number
+                self.metrics.report_progress(done_locations[0], size)
+        
+        def iter_tasks():
+            for chunk_plan in plan:
+                tasks = list(chunk_plan.iter_tasks(deduplicate=deduplicate))
+                conclude_locations(chunk_plan.size - len(tasks))
+                yield from tasks
+        
+        # with processes, each stitch worker thread waits for one process.
+        # a slab fits the largest tiles of a location, there is one for each
+        # location being stitched or waiting for the writer.
+        process_pool = None
+        slab_pool = None
+        if stitch_processes is not None:
+            stitch_workers = stitch_processes
+            largest_tile_sizes = [max(tile_sizes) for tile_sizes
+                                  in zip(*self.tile_sizes_dict.values())]
+            slab_pool = SharedSlabPool(
+                self.tile_stitcher.get_tile_nbytes(largest_tile_sizes) + 4096,
+                (stitch_processes + queue_size + 1) if shared_slabs is None else shared_slabs,
+                silent=self.silent)
+            # the slabs exist before the processes are started
+            process_pool = ProcessPoolExecutor(max_workers=stitch_processes)
+        
+        # each stitch worker has its own stitcher (tile sizes are set per
+        # location) keeping the tiles in memory for the writer
+        worker_stitchers = []
+        local = threading.local()
+        def get_worker_stitcher():
+            if not hasattr(local, "tile_stitcher"):
+                if process_pool is not None:
+                    local.tile_stitcher = ProcessPoolStitcher(
+                        self.tile_stitcher, process_pool, slab_pool)
+                else:
+                    local.tile_stitcher = copy.copy(self.tile_stitcher)
+                    local.tile_stitcher.statistics = {}
+                    local.tile_stitcher.set_sink(MemorySink(silent=self.silent))
+                worker_stitchers.append(local.tile_stitcher)
+            return local.tile_stitcher
+        
+        def fetch_location(item):
+            idx, location, dt = item
+            cache_rows = []
+            build_query = self.build_query(location, dt)
+            file_name = self.make_file_name(idx, size, location, build_query)
+            # tiles stored already or made for an earlier location of the run
+            # are documented by the writer (after the earlier location)
+            reserved = self.reserve_tiles(file_name, wait=False)
+            if not reserved or self.has_tiles(build_query, file_name):
+                if reserved:
+                    self.release_tiles(file_name)
+                return (location, dt, make_location_id(idx), cache_rows, build_query,
+                        None, file_name)
+            raw_file_names = self.fetch_tiles(build_query, location, cache_rows=cache_rows)
+            return (location, dt, make_location_id(idx), cache_rows, build_query,
+                    raw_file_names, file_name)
+        
+        def stitch_location(item):
+            location, dt, location_id, cache_rows, build_query, raw_file_names, file_name = item
+            if raw_file_names is None:
+                return (location, dt, location_id, cache_rows, build_query, file_name,
+                        None, [])
+            tile_stitcher = get_worker_stitcher()
+            stitched_tiles = []
+            for file_suffix, queries, raw_files in self.group_acquisitions(
+                    build_query, raw_file_names):
+                image_manipulation = self.stitch_tiles(
+                    queries, raw_files, f"{file_name}{file_suffix}",
+                    location, dt, document=False, tile_stitcher=tile_stitcher)
+                entries = tile_stitcher.sink.pop_entries()
+                if image_manipulation is not None:
+                    stitched_tiles.append((image_manipulation, entries))
+            held_slabs = [] if slab_pool is None else tile_stitcher.pop_held_slabs()
+            return (location, dt, location_id, cache_rows, build_query, file_name,
+                    stitched_tiles, held_slabs)
+        
+        def write_location(item):
+            (location, dt, location_id, cache_rows, build_query, file_name,
+             stitched_tiles, held_slabs) = item
+            if stitched_tiles is None:
+                # the rows of the stored tiles are written for this location
+                # too, unless they could not be made
+                if self.has_tiles(build_query, file_name):
+                    self.document_stored_tiles(build_query, file_name, location, dt,
+                                               location_id)
+                    self.metrics.count("locations_total", status="skipped")
+                else:
+                    self.metrics.count("locations_total", status="failed")
+                conclude_locations(1)
+                return None
+            try:
+                for csv_row_dict in cache_rows:
+                    self.write_index_row("cache", csv_row_dict)
+                # the tiles of a location are encoded in one stage
+                encode_duration = sum(
+                    self.store_tiles(image_manipulation, entries, location, dt, location_id)
+                    for image_manipulation, entries in stitched_tiles)
+                self.metrics.observe("encode", encode_duration)
+            finally:
+                # the tiles are stored, their slabs can be reused
+                for slab_index in held_slabs:
+                    slab_pool.release(slab_index)
+                self.release_tiles(file_name)
+            self.metrics.count("locations_total", status="written")
+            conclude_locations(1)
+            return None
+        
+        pipeline = StagedPipeline([
+            PipelineStage("fetch", fetch_location, workers=fetch_workers),
+            PipelineStage("stitch", stitch_location, workers=stitch_workers),
+            PipelineStage("write", write_location, workers=1)
+        ], queue_size=queue_size, ordered=True, silent=self.silent)
+        try:
+            pipeline.run(iter_tasks())
+        finally:
+            if process_pool is not None:
+                process_pool.shutdown()
+                slab_pool.close()
+            # tiles of failed locations are not reserved anymore
+            self.release_tiles()
+            # the statistics of all workers are combined
+            for tile_stitcher in worker_stitchers:
+                self.tile_stitcher.merge_statistics(tile_stitcher.statistics)
+            # also after failed items the sink is closed and the statistics
+            # of the written tiles are stored
+            self.finalize()
+            self.export_metrics(done_locations[0])
+        return
+    
+    
+    def iter_tiles(self, locations, dates=None, prefetch=2, write=False):
+        '''
+        Yield the tiles for each location as soon as they are stitched,
+        without storing them (unless `write`). Without `write` only the
+        tile index is loaded, neither the csv files nor the sink are set up
+        (and downloads are not documented in the cache index).
+        
+        For each location (and acquisition in time series mode) a tuple of
+        the location index, a dictionary of the tile arrays by feature
+        (`{feature}_{scale}` for multiple scales) and a dictionary with the
+        metadata of the tiles is yielded. The raw tiles of up to `prefetch`
+        following locations are fetched in the background meanwhile.
+        '''
+        from collections import deque
+        from concurrent.futures import ThreadPoolExecutor
+        
+        self.authenticate()
+        reset_made_directories()
+        plan = LocationStream.from_input(locations, dates, silent=self.silent)
+        size = plan.total_number
+        # the index needs to be loaded before the fetching threads start
+        if write and not self.prepared:
+            self.prepare()
+            self.prepared = True
+        else:
+            self.prepare_index()
+        
+        # the tiles are kept in memory and only stored afterwards if wanted
+        memory_sink = MemorySink(silent=self.silent)
+        stitcher_sink = self.tile_stitcher.sink
+        self.tile_stitcher.set_sink(memory_sink)
+        
+        def fetch_location(location, dt):
+            build_query = self.select_tiles(location, dt)
+            # without csv files the downloads are not documented
+            return build_query, self.fetch_tiles(build_query, location,
+                                                 cache_rows=None if write else [])
+        
+        # at most `prefetch` locations are fetched ahead, so memory stays bounded.
+        # the tiles are yielded in the order of the locations.
+        location_queue = plan.iter_tasks(spatial_order=False)
+        pending = deque()
+        executor = ThreadPoolExecutor(max_workers=max(prefetch, 1))
+        
+        def submit_next():
+            next_item = next(location_queue, None)
+            if next_item is not None:
+                idx, location, dt = next_item
+                pending.append((idx, location, dt,
+                                executor.submit(fetch_location, location, dt)))
+            return
+        
+        try:
+            for _ in range(max(prefetch, 1)):
+                submit_next()
+            while len(pending) > 0:
+                idx, location, dt, fetched = pending.popleft()
+                submit_next()
+                
+                try:
+                    build_query, raw_file_names = fetched.result()
+                except AssertionError as err:
+                    if not self.silent : print(
+                        f"Error, no tiles were found for location "
+                        f"{coordinatify_point(location)}. {err}")
+                    continue
+                
+                for feature_tiles, tile_metadata in self.extract_tiles(
+                        build_query, raw_file_names,
+                        self.make_file_name(idx, size, location, build_query),
+                        location, dt, memory_sink, write=write,
+                        location_id=make_location_id(idx)):
+                    yield idx, feature_tiles, tile_metadata
+        finally:
+            # also if the consumer stops early, no further locations are fetched
+            executor.shutdown(wait=True, cancel_futures=True)
+            self.tile_stitcher.set_sink(stitcher_sink)
+        
+        if write:
+            self.finalize()
+        return
+    
+    
+    def extract_tiles(self, build_query, raw_file_names, file_name, location,
+                      date_given, memory_sink, write=False, location_id=None):
+        '''
+        Stitch the fetched raw tiles of a location into memory.
+        
+        A list of tuples of the tile arrays by feature (`{feature}_{scale}`
+        for multiple scales) and their metadata is returned, one for each
+        acquisition. The stitcher needs to write into `memory_sink`, which
+        does not pass the tiles on; with `write` they are stored afterwards.
+        '''
+        extracted_tiles = []
+        for file_suffix, queries, raw_files in self.group_acquisitions(
+                build_query, raw_file_names):
+            image_manipulation = self.stitch_tiles(
+                queries, raw_files, f"{file_name}{file_suffix}", location, date_given,
+                document=False, location_id=location_id)
+            entries = memory_sink.pop_entries()
+            if image_manipulation is None:
+                continue
+            tiles = {(feature, scale): feature_tile
+                     for _, feature, scale, feature_tile, _ in entries}
+            if write:
+                self.metrics.observe("encode", self.store_tiles(
+                    image_manipulation, entries, location, date_given, location_id))
+            
+            multi_scale = len(self.tile_stitcher.tile_sizes) > 1
+            feature_tiles = {}
+            tile_metadata = {}
+            for manipulation_dict in image_manipulation.values():
+                feature_scale = (manipulation_dict["feature"], manipulation_dict["scale"])
+                tile_key = "_".join(feature_scale) if multi_scale else feature_scale[0]
+                feature_tiles[tile_key] = tiles[feature_scale]
+                tile_metadata[tile_key] = manipulation_dict
+            extracted_tiles.append((feature_tiles, {
+                "location": location,
+                "location_id": location_id,
+                "date_requested": date_given,
+                "date_obtained": _get_resolution_and_date(queries[0])[1],
+                "tiles": tile_metadata
+            }))
+        return extracted_tiles
+    
+    
+    def group_acquisitions(self, build_query, raw_file_names):
+        '''
+        Group the queries and raw files by acquisition date in time series
+        mode.
+        
+        Tuples of a file name suffix, the queries and the raw files are
+        returned. Without time series mode all files form one group.
+        '''
+        if not self.time_series:
+            return [("", build_query, raw_file_names)]
+        
+        acquisitions = {}
+        for query, raw_file_name in zip(build_query, raw_file_names):
+            acquisition_date = _get_resolution_and_date(query)[1]
+            acquisitions.setdefault(acquisition_date, ([], []))
+            acquisitions[acquisition_date][0].append(query)
+            acquisitions[acquisition_date][1].append(raw_file_name)
+        return [(f"_{acquisition_date.year}", queries, raw_files)
+                for acquisition_date, (queries, raw_files) in sorted(acquisitions.items())]
+    
+    
+    def fetch_tiles(self, build_query, location, cache_rows=None):
+        '''
+        Download (or load from local source) all raw tiles of a query and
+        return their local file names.
+        
+        If a list of `cache_rows` is given, the csv rows documenting new
+        downloads are collected in it instead of being written.
+        '''
         # first download the whole image (or load from local source)
         raw_file_names = []
         for query in build_query:
             try:
-                dest_file_path, csv_row_dict = self.datasource.fetch_data(
-                    query, NaipMetCacheAssembler)
+                with time_stage(self.metrics, "fetch"):
+                    dest_file_path, csv_row_dict = self.datasource.fetch_data(
+                        query, NaipMetCacheAssembler)
 
             except PermissionError: # WHAT do i want to except? PermissionError? TODO 
                 if not self.silent : print(
@@ -190,39 +822,239 @@ class NAIPData(SpatialData):
                     f" `{query}` at location `{coordinatify_point(location)}`. No permission.")
             else:
                 # document the new data retrieved.
-                if csv_row_dict is not None:
-                    write_csv_row(self.csv_index_files["cache"], csv_row_dict)
+                if csv_row_dict is None:
+                    pass
+                elif cache_rows is not None:
+                    cache_rows.append(csv_row_dict)
+                else:
+                    self.write_index_row("cache", csv_row_dict)
             raw_file_names.append(dest_file_path)
+        return raw_file_names
+    
+    
+    def stitch_tiles(self, build_query, raw_file_names, file_name, location, date_given,
+                     document=True, tile_stitcher=None, location_id=None):
+        '''
+        Stitch the tile(s) of one acquisition date around a location and
+        document the features (if `document`).
+        
+        Another stitcher than the one of the dataminer can be given (e.g.
+        one for each concurrent worker).
+        '''
+        if tile_stitcher is None:
+            tile_stitcher = self.tile_stitcher
+        rd_tuple = _get_resolution_and_date(build_query[0])  # TODO is this actually right to do?
+        # the window size in pixels depends on resolution and year
+        scale_labels = [f"{ts}m" for ts in self.get_tile_sizes()]
+        tile_stitcher.set_tile_size(self.tile_sizes_dict[rd_tuple],
+                                    scale_labels=scale_labels)
         try:
-            image_manipulation = self.tile_stitcher.stitch_image(
+            image_manipulation = tile_stitcher.stitch_image(
                     location, raw_file_names, file_name_prefix=file_name)
         except ValueError as err: # WHAT do i want to except TODO
             print(f"Error, it was impossible to stitch data for the queries"
                     f" '{build_query}' at location {coordinatify_point(location)}. {err}")
+            # the location is retried by a resumed run
+            self.record_state("failed", repr(err))
             image_manipulation = None
         else:
-            # TODO
-            for feature in self.features:
-                final_file_name = f"{file_name}.tif".replace(
-                    "FEATURE_PLACE_HOLDER", feature)  # same as in image_manipulation.py
+            if document:
+                self.document_tiles(image_manipulation, location, date_given, location_id)
+        
+        return image_manipulation
+    
+    
+    def store_tiles(self, image_manipulation, entries, location, date_given,
+                    location_id=None):
+        '''
+        Store the tiles kept in memory (the `entries` of a memory sink) with
+        the tile sink and document each right after it was stored, so no
+        stored tile lacks its row if a later one fails.
+        
+        The time spent storing (encoding) the tiles is returned (s).
+        '''
+        import time
+        
+        encode_duration = 0.0
+        for file_name, feature, scale, feature_tile, profile in entries:
+            start = time.perf_counter()
+            file_path, image_info_dict = self.tile_sink.write_tile(
+                file_name, feature, scale, feature_tile, profile)
+            encode_duration += time.perf_counter() - start
+            image_manipulation[file_name]["file_path"] = file_path
+            image_manipulation[file_name]["image_info"] = image_info_dict
+            self.document_tiles({file_name: image_manipulation[file_name]},
+                                location, date_given, location_id)
+        return encode_duration
+    
+    
+    def document_tiles(self, image_manipulation, location, date_given, location_id=None):
+        '''
+        Write one csv row for each feature and scale of the stitched tiles.
+        
+        The id of the location lines the rows up with the input locations,
+        also when the files are named by content.
+        '''
+        scale_labels = [f"{ts}m" for ts in self.get_tile_sizes()]
+        metric_sizes = dict(zip(scale_labels, self.get_tile_sizes()))
+        for final_file_name, manipulation_dict in image_manipulation.items():
+            with time_stage(self.metrics, "metadata_write"):
                 csv_row_dict = self.make_csv_row(NaipMetFeatureAssembler,
-                    location=location, date_requested=date_given, tile_size=self.tile_size,
-                    file_name=final_file_name, manipulation_dict=image_manipulation[final_file_name]
+                    location=location, location_id=location_id, date_requested=date_given,
+                    tile_size=metric_sizes[manipulation_dict["scale"]],
+                    file_name=manipulation_dict.get("file_path", final_file_name),
+                    manipulation_dict=manipulation_dict
                 )
-                write_csv_row(self.csv_index_files[feature], csv_row_dict)
-        
+                self.write_index_row(manipulation_dict["feature"], csv_row_dict)
+                self.tile_sink.write_row(manipulation_dict, csv_row_dict)
         return
 
     
-    def make_file_name(self, index, total_number):
+    def document_stored_tiles(self, build_query, file_name, location, date_given,
+                              location_id=None):
+        '''
+        Write the rows of tiles stored already (e.g. for a repeated
+        location) for another location, pointing at the stored tiles.
+        
+        The rows are copied from the csv index of each feature, unless the
+        location has rows already (e.g. in a rerun). The tables of the sink
+        stay aligned to the stored tiles and get no rows.
+        '''
+        location_id = "NA" if location_id is None else location_id
+        scale_labels = [f"{ts}m" for ts in self.get_tile_sizes()]
+        for file_suffix, _, _ in self.group_acquisitions(build_query, build_query):
+            filepath_prefix = os.path.abspath(f"{file_name}{file_suffix}")
+            for feature in self.features:
+                references = {self.tile_sink.find_tile(
+                    self.tile_stitcher.make_final_image_name(
+                        filepath_prefix, feature, scale_label), feature, scale_label)
+                    for scale_label in scale_labels}
+                with self.lock_index_files():
+                    stored_rows = find_csv_rows(self.csv_index_files[feature], "file_path",
+                                                references)
+                for reference in sorted(references, key=str):
+                    if reference not in stored_rows:
+                        if not self.silent : print(
+                            f"The row of the stored tile `{reference}` was not found.")
+                        continue
+                    reused_row = {
+                        **stored_rows[reference][0],
+                        "location": coordinatify_point(location),
+                        "location_id": location_id,
+                        "date_requested": str(date_given)
+                    }
+                    if reused_row in stored_rows[reference]:
+                        continue
+                    with time_stage(self.metrics, "metadata_write"):
+                        self.write_index_row(feature, reused_row)
+        return
+    
+    
+    def write_index_row(self, database_feature, csv_row_dict):
+        '''
+        Append a row to the csv index of a feature (or the cache), one
+        worker at a time.
+        '''
+        with self.lock_index_files():
+            write_csv_row(self.csv_index_files[database_feature], csv_row_dict)
+        return
+    
+    
+    def lock_index_files(self):
         '''
-        Combine date and location to make a unique filename.
+        Return the lock of the csv index files, which the workers of a run
+        share with the sink (a lock doing nothing without workers).
         '''
-        today = str(date.today()).replace("-", "_")
-        padding = total_number//10 + 2
-        file_name = "/".join([self.database_dir, "FEATURE_PLACE_HOLDER",
-            f"{today}_loc_{str(index+1).zfill(padding)}"])
-        return file_name
+        import contextlib
+        
+        sink_lock = getattr(self, "sink_lock", None)
+        return contextlib.nullcontext() if sink_lock is None else sink_lock
+    
+    
+    def finalize(self):
+        '''
+        Close the tile sink and store the band statistics of all tiles of
+        each feature in a json file (only tiles stitched in the `mosaic`
+        stitch mode have statistics).
+        '''
+        import json
+        import threading
+        
+        if hasattr(self, "tile_sink"):
+            self.tile_sink.close()
+        # the reservations shared with processes end with the run
+        if getattr(self, "reservation_manager", None) is not None:
+            self.tile_reservations = {}
+            self.reservation_lock = threading.Lock()
+            self.reservation_manager.shutdown()
+            self.reservation_manager = None
+        
+        for feature in self.features:
+            feature_statistics = {
+                scale_label: band_statistics.to_dict()
+                for (stats_feature, scale_label), band_statistics
+                in self.tile_stitcher.statistics.items() if stats_feature == feature}
+            if len(feature_statistics) == 0:
+                continue
+            statistics_file_name = os.path.join(
+                self.datasource.destination.destination_dir, feature,
+                f"statistics_{self.db_name}_{feature}.json")
+            with open(statistics_file_name, "w") as statistics_file:
+                json.dump(feature_statistics, statistics_file)
+            if not self.silent : print(
+                f"Band statistics of `{feature}` were stored in `{statistics_file_name}`.")
+        return
+    
+    
+    def has_tiles(self, build_query, file_name):
+        '''
+        Check if the tiles of all acquisitions of a query are stored already
+        under a content keyed file name.
+        '''
+        if self.file_naming != "content":
+            return False
+        # only the file name suffixes of the acquisitions are needed
+        # the scale labels are only set on the stitcher when stitching
+        scale_labels = [f"{ts}m" for ts in self.get_tile_sizes()]
+        return all(self.tile_stitcher.has_tiles(f"{file_name}{file_suffix}", scale_labels)
+                   for file_suffix, _, _ in self.group_acquisitions(build_query, build_query))
+    
+    
+    def make_content_key(self, location, build_query):
+        '''
+        Return the key of the tiles of a location, derived from its
+        coordinates, the tile size and the source tiles of the query.
+        
+        The source tile paths name the version and acquisition of the
+        raw data (resolved from the requested date), so equal keys mean
+        equal tiles, independent of the day or order of the run.
+        '''
+        import hashlib
+        import json
+        
+        content = json.dumps([round(location.x, 7), round(location.y, 7), self.tile_size,
+                              self.pixel_size, self.tile_stitcher.stitch_mode,
+                              sorted(build_query)], default=str)
+        return hashlib.sha1(content.encode()).hexdigest()[:20]
+    
+    
+    def make_file_name(self, index, total_number, location=None, build_query=None):
+        '''
+        Make a unique filename for a location.
+        
+        With content naming (and a location and its query given) the name
+        is the content key of the tiles, otherwise date and index of the
+        location are combined. The file is placed in `fan_out_levels` hash
+        named directories.
+        '''
+        if self.file_naming == "content" and location is not None:
+            file_name = "/".join([self.database_dir, "FEATURE_PLACE_HOLDER",
+                                  self.make_content_key(location, build_query)])
+        else:
+            today = str(date.today()).replace("-", "_")
+            file_name = "/".join([self.database_dir, "FEATURE_PLACE_HOLDER",
+                f"{today}_{make_location_id(index)}"])
+        return make_fan_out_path(file_name, levels=self.fan_out_levels)
 # end NAIPData
 
 
@@ -230,15 +1062,22 @@ class NaipMetFeatureAssembler(MetAssembler):
     '''
     Class to assemble csv row including feature specific metadata
     for the extracted tiles.
+    
+    The band statistics (nodata fraction, band mean and std) are only
+    computed in the `mosaic` stitch mode, in the `cv2` mode they are NA.
     '''
     HEADER = [
             "location",  # coordinates of the request
+            "location_id",  # stable id of the location in the input
             "date_requested",  # date which was requested
             "date_obtained",  # date of image capture (could be list)
             "tilesize",  # metric edgelength of tile
             "file_path",  # absolute path of the file
             "manipulation",  # information about processing of raw file(s)
             "completeness",  # tells if complete tile was retrieved
+            "nodata_fraction",  # fraction of pixels without data
+            "band_mean",  # mean of each band (| separated)
+            "band_std",  # standard deviation of each band (| separated)
             "source",  # path(s)/url(s) of raw data used to obtain file
             "timestamp_create",  # timestamp of when file was created
             "file_type",  # format/type of the file
@@ -247,7 +1086,7 @@ class NaipMetFeatureAssembler(MetAssembler):
             "image_mode"  # information about the image profile
     ]
     
-    def build_row(location=None, date_requested=None, tile_size=None,
+    def build_row(location=None, location_id=None, date_requested=None, tile_size=None,
                   file_name=None, manipulation_dict=None):
         '''
         Build the feature specific row for a tile.
@@ -260,16 +1099,23 @@ class NaipMetFeatureAssembler(MetAssembler):
         substr_obtained = map(lambda x: x.split("_")[-1], re.findall(REGEX, raw_files))
         dates_obtained = map(lambda x: parser.parse(x).date(), substr_obtained)
         datestr_obtained =  "|".join([str(d) for d in dates_obtained])
-        image_info_dict = retrieve_image_info(file_name) 
+        # tiles in array stores are no files, their info is given
+        image_info_dict = manipulation_dict.get("image_info")
+        if image_info_dict is None:
+            image_info_dict = retrieve_image_info(file_name)
 
         csv_row = [  # same order as self.HEADER
             coordinatify_point(location),  # location
+            "NA" if location_id is None else location_id,  # location_id
             str(date_requested),  # date_requested
             datestr_obtained,  # date_obtained
             tile_size,  # tilesize
             file_name,  # file_path
             manipulation_dict["manipulations"],  # manipulation
             manipulation_dict["completeness"],  # completeness
+            manipulation_dict.get("nodata_fraction", "NA"),  # nodata_fraction
+            manipulation_dict.get("band_mean", "NA"),  # band_mean
+            manipulation_dict.get("band_std", "NA"),  # band_std
             raw_files,  # source
             image_info_dict["timestamp_created"],  # timestamp_create
             image_info_dict["format"],  # file_type
@@ -397,10 +1243,10 @@ def _select_intersected_tiles(point, date_preferred, tile_rtree, tile_index,
 # obtain tile size in pixels for a resolution_year_tuple.
 # the first image in the index, sharing this tuple is
 # used for the estimation
-def _compute_tile_pixel_dict(tile_size, tile_index, resolution_year_tuple_list,
+def _compute_tile_pixel_dict(tile_sizes, tile_index, resolution_year_tuple_list,
         data_source):
     '''
-    Compute the tile size in pixels for all tuples of resolution and year.
+    Compute the tile sizes in pixels for all tuples of resolution and year.
     '''
     # we extract name and geom of the first image that is in given
     # resolution from given year. this is standardized, as index 
@@ -413,16 +1259,16 @@ def _compute_tile_pixel_dict(tile_size, tile_index, resolution_year_tuple_list,
         # always run it for the first given tile providing an ryt
         if tile_sizes_dict[ryt] is None:
             tile_sizes_dict[ryt] = _compute_tile_pixel(
-                tile_size, tile_index, i, data_source)
+                tile_sizes, tile_index, i, data_source)
         if all([tv is not None for tv in tile_sizes_dict.values()]):
             break
 
     return tile_sizes_dict
 
 
-def _compute_tile_pixel(tile_size, tile_index, first_tile_index, datasource):
+def _compute_tile_pixel(tile_sizes, tile_index, first_tile_index, datasource):
     '''
-    Compute the tile size in pixel for a file given its index.
+    Compute the tile sizes in pixel for a file given its index.
     '''
     tile_query = tile_index[first_tile_index][0]
     tile_geom = tile_index[first_tile_index][1]
@@ -440,11 +1286,14 @@ def _compute_tile_pixel(tile_size, tile_index, first_tile_index, datasource):
     # finally, multiplied by tilesize in metres this gives us the
     # number of pixels per tile. we use ceiling, so the tiles are 
     # as large as, or larger, than wanted.
-    tile_size_pixels = int(np.ceil(pixels_per_metres*tile_size))
-    # for symmetric data extraction even pixelsizes are preferred.
-    if tile_size_pixels % 2 == 1:
-        tile_size_pixels += 1 
-    return tile_size_pixels
+    tile_sizes_pixels = []
+    for tile_size in tile_sizes:
+        tile_size_pixels = int(np.ceil(pixels_per_metres*tile_size))
+        # for symmetric data extraction even pixelsizes are preferred.
+        if tile_size_pixels % 2 == 1:
+            tile_size_pixels += 1
+        tile_sizes_pixels.append(tile_size_pixels)
+    return tile_sizes_pixels
 
 
 # retrieve dimensions (height, width) of image in pixels
@@ -0,0 +1,611 @@
+# here one can find the sinks, which store the tiles
+# extracted by the dataminers (e.g. as single files or
+# in one chunked array store).
+from abc import ABCMeta
+from abc import abstractmethod
+import os
+
+from utils import make_directory
+from utils import migrate_csv_header
+from utils import write_csv_row
+
+# the implemented output formats
+OUTPUT_FORMATS = ["geotiff", "zarr", "hdf5", "tar"]
+
+
+## classes ##
+class AbstractSink(metaclass=ABCMeta):
+    '''
+    Base class for all sinks of extracted tiles.
+    '''
+    def __init__(self, silent=True):
+        self.silent = silent
+        return
+
+
+    @abstractmethod
+    def write_tile(self, file_name, feature, scale, feature_tile, profile):
+        '''
+        Store a tile (bands, height, width) of a feature and scale.
+
+        A reference to the stored tile and a dictionary with image
+        information (or None if it can be read from the file) are returned.
+        '''
+        return  # return reference, image_info_dict
+
+
+    def find_tile(self, file_name, feature, scale):
+        '''
+        Return the reference of a tile stored already, None if it is not
+        stored (or unknown by default, so tiles are written again).
+        '''
+        return None
+
+
+    def has_tile(self, file_name, feature, scale):
+        '''
+        Check if a tile is already stored.
+        '''
+        return self.find_tile(file_name, feature, scale) is not None
+
+
+    def write_row(self, manipulation_dict, csv_row_dict):
+        '''
+        Document the metadata row of a stored tile (nothing to do by default).
+        '''
+        return
+
+
+    def close(self):
+        '''
+        Release all open resources (nothing to do by default).
+        '''
+        return
+# end AbstractSink
+
+
+class GeoTiffSink(AbstractSink):
+    '''
+    Sink storing each tile as georeferenced tif file.
+    '''
+    def write_tile(self, file_name, feature, scale, feature_tile, profile):
+        '''
+        Store a tile as tif at the given file name.
+        '''
+        from rasterio.errors import RasterioIOError
+
+        # the directories of fanned out file names are created on demand
+        make_directory(os.path.dirname(file_name))
+        try:
+            write_feature_tile(file_name, feature_tile, profile)
+        except RasterioIOError:
+            # the directory may have been removed since (e.g. by a cleanup)
+            if os.path.exists(os.path.dirname(file_name)):
+                raise
+            make_directory(os.path.dirname(file_name), force=True)
+            write_feature_tile(file_name, feature_tile, profile)
+        return file_name, None
+
+
+    def find_tile(self, file_name, feature, scale):
+        '''
+        Return the tif file of a tile if it exists.
+        '''
+        return file_name if os.path.exists(file_name) else None
+# end GeoTiffSink
+
+
+class ArrayStoreSink(AbstractSink):
+    '''
+    Sink storing all tiles of a feature and scale in one chunked
+    N x C x H x W array of a zarr or hdf5 store.
+
+    For each array a csv table, which is aligned to its first axis,
+    holds file name, location, date and metadata of the tiles. Stored
+    tiles are looked up by their file name in the table.
+    '''
+    DEFAULT_COMPRESSION = {"zarr": "zstd", "hdf5": "gzip"}
+
+    def __init__(self, store_path, store_format="zarr", compression=None,
+                 compression_level=5, chunk_tiles=16, silent=True):
+        '''
+        Construct a sink for a store at the given path.
+
+        `chunk_tiles` tiles are stored together in one chunk.
+        '''
+        super().__init__(silent=silent)
+        assert store_format in self.DEFAULT_COMPRESSION, (
+            f"Array stores can be `{'` or `'.join(self.DEFAULT_COMPRESSION)}`, "
+            f"not `{store_format}`.")
+        self.store_path = store_path
+        self.store_format = store_format
+        self.compression = (self.DEFAULT_COMPRESSION[store_format]
+                            if compression is None else compression)
+        self.compression_level = compression_level
+        self.chunk_tiles = chunk_tiles
+
+        # the store is opened on first write
+        self.store = None
+        # tables of former runs get newer metadata columns once
+        self.migrated_tables = set()
+        # file names of the tiles written, until their rows are written
+        self.written_names = {}
+        # indexes of the stored tiles by file name for each array, loaded
+        # from the tables on demand
+        self.tile_indexes = {}
+        return
+
+
+    def open(self):
+        '''
+        Open (or create) the array store.
+        '''
+        if self.store_format == "zarr":
+            import zarr
+            self.store = zarr.open_group(self.store_path, mode="a")
+        else:
+            import h5py
+            self.store = h5py.File(self.store_path, "a")
+        if not self.silent : print(
+            f"Tiles will be stored in the {self.store_format} store `{self.store_path}`.")
+        return
+
+
+    def write_tile(self, file_name, feature, scale, feature_tile, profile):
+        '''
+        Append a tile to the array of its feature and scale.
+        '''
+        import time
+
+        if self.store is None:
+            self.open()
+        array_name = f"{feature}/{scale}"
+        array = self.get_array(array_name, feature_tile)
+        if tuple(array.shape[1:]) != feature_tile.shape:
+            raise ValueError(
+                f"The tile ({feature_tile.shape}) does not fit the shape of the array "
+                f"`{array_name}` ({tuple(array.shape[1:])}). Use a common pixel size.")
+
+        index = array.shape[0]
+        array.resize((index + 1,) + feature_tile.shape)
+        array[index] = feature_tile
+        reference = f"{self.store_path}::{array_name}/{index}"
+        self.written_names[reference] = file_name
+
+        image_info_dict = {
+            "timestamp_created": time.time(),
+            "format": self.store_format,
+            "file_size": feature_tile.nbytes,
+            "pixel_size": (feature_tile.shape[2], feature_tile.shape[1]),
+            "mode": feature_tile.dtype.name
+        }
+        return reference, image_info_dict
+
+
+    def find_tile(self, file_name, feature, scale):
+        '''
+        Return the reference of a tile, if its file name is in the table of
+        its array.
+        '''
+        import csv
+        
+        table_file_name = self.make_table_file_name(feature, scale)
+        if table_file_name not in self.tile_indexes:
+            tile_indexes = {}
+            if os.path.exists(table_file_name):
+                with open(table_file_name, "r") as table_file:
+                    tile_indexes.update((row["file_name"], row["index"])
+                                        for row in csv.DictReader(table_file)
+                                        if row.get("file_name", "NA") != "NA")
+            self.tile_indexes[table_file_name] = tile_indexes
+        index = self.tile_indexes[table_file_name].get(file_name)
+        return None if index is None else f"{self.store_path}::{feature}/{scale}/{index}"
+
+
+    def make_table_file_name(self, feature, scale):
+        '''
+        Return the file name of the csv table of the array of a feature and scale.
+        '''
+        return f"{os.path.splitext(self.store_path)[0]}_{feature}_{scale}.csv"
+
+
+    def get_array(self, array_name, feature_tile):
+        '''
+        Return the array of a feature and scale, which is created if not existing.
+        '''
+        if array_name in self.store:
+            return self.store[array_name]
+
+        shape = (0,) + feature_tile.shape
+        chunks = (self.chunk_tiles,) + feature_tile.shape
+        if self.store_format == "zarr":
+            from numcodecs import Blosc
+            return self.store.create_dataset(
+                array_name, shape=shape, chunks=chunks, dtype=feature_tile.dtype,
+                compressor=Blosc(cname=self.compression, clevel=self.compression_level))
+        return self.store.create_dataset(
+            array_name, shape=shape, maxshape=(None,) + feature_tile.shape,
+            chunks=chunks, dtype=feature_tile.dtype, compression=self.compression,
+            compression_opts=(self.compression_level if self.compression == "gzip"
+                              else None))
+
+
+    def write_row(self, manipulation_dict, csv_row_dict):
+        '''
+        Append the metadata row of a tile to the table of its array.
+        '''
+        table_file_name = self.make_table_file_name(
+            manipulation_dict["feature"], manipulation_dict["scale"])
+        index = manipulation_dict["file_path"].split("/")[-1]
+        file_name = self.written_names.pop(manipulation_dict["file_path"], "NA")
+        aligned_row_dict = {
+            "index": index,
+            "file_name": file_name,
+            **csv_row_dict,
+            "crs": manipulation_dict.get("crs", "NA"),
+            "transform": manipulation_dict.get("transform", "NA")
+        }
+        if table_file_name not in self.migrated_tables:
+            migrate_csv_header(table_file_name, aligned_row_dict.keys())
+            self.migrated_tables.add(table_file_name)
+        write_csv_row(table_file_name, aligned_row_dict)
+        if table_file_name in self.tile_indexes and file_name != "NA":
+            self.tile_indexes[table_file_name][file_name] = index
+        return
+
+
+    def __getstate__(self):
+        '''
+        Drop the open store when pickled, it is reopened on the next write.
+        '''
+        state = self.__dict__.copy()
+        state["store"] = None
+        return state
+    
+    
+    def close(self):
+        '''
+        Close the store (hdf5 files need to be closed).
+        '''
+        if self.store is not None and self.store_format == "hdf5":
+            self.store.close()
+        self.store = None
+        return
+# end ArrayStoreSink
+
+
+class TarShardSink(AbstractSink):
+    '''
+    Sink packing the tiles and their metadata (json) into rolling tar
+    shards (webdataset style) for sequential streaming.
+    
+    All members of a location share the same key, so shards are only
+    rolled over between locations. A csv index of all members with their
+    data offsets allows seeking within the shards.
+    '''
+    def __init__(self, shard_dir, shard_size=2**30, silent=True):
+        '''
+        Construct a sink writing shards of (roughly) `shard_size` bytes
+        into a directory.
+        '''
+        super().__init__(silent=silent)
+        self.shard_dir = shard_dir
+        self.shard_size = shard_size
+        self.index_file_name = os.path.join(shard_dir, "shards_index.csv")
+        
+        # the shard is opened on first write
+        self.shard = None
+        self.shard_path = None
+        self.last_key = None
+        # shards of the members in all shards by name, loaded from the index
+        # on demand
+        self.member_shards = None
+        return
+    
+    
+    def open_next_shard(self):
+        '''
+        Close the current shard and open the following one.
+        '''
+        import glob
+        import tarfile
+        
+        self.close()
+        if not os.path.exists(self.shard_dir):
+            os.makedirs(self.shard_dir, exist_ok=True)
+        # the shard following the last one is created exclusively, so a shard
+        # of another writer is never overwritten
+        shard_numbers = [int(os.path.basename(shard_path)[6:-4]) for shard_path
+                         in glob.glob(os.path.join(self.shard_dir, "shard_*.tar"))]
+        shard_number = max(shard_numbers, default=-1) + 1
+        while True:
+            self.shard_path = os.path.join(self.shard_dir, f"shard_{shard_number:06d}.tar")
+            try:
+                self.shard = tarfile.open(self.shard_path, "x")
+                break
+            except FileExistsError:
+                shard_number += 1
+        if not self.silent : print(
+            f"Tiles will be packed into the shard `{self.shard_path}`.")
+        return
+    
+    
+    def add_member(self, key, member_name, data):
+        '''
+        Add bytes as member to the current shard and document it in the index.
+        '''
+        import io
+        import tarfile
+        import time
+        
+        # shards are rolled over only before the members of a new location
+        if (self.shard is None or (key != self.last_key and
+                                   self.shard.offset >= self.shard_size)):
+            self.open_next_shard()
+        self.last_key = key
+        
+        member_info = tarfile.TarInfo(member_name)
+        member_info.size = len(data)
+        member_info.mtime = time.time()
+        self.shard.addfile(member_info, io.BytesIO(data))
+        # the data ends the member, padded to full tar blocks
+        padded_size = -(-member_info.size//tarfile.BLOCKSIZE)*tarfile.BLOCKSIZE
+        if self.member_shards is not None:
+            self.member_shards[member_name] = self.shard_path
+        write_csv_row(self.index_file_name, {
+            "key": key,
+            "member": member_name,
+            "shard": self.shard_path,
+            "offset": self.shard.offset - padded_size,
+            "size": member_info.size
+        })
+        return f"{self.shard_path}::{member_name}"
+    
+    
+    def write_tile(self, file_name, feature, scale, feature_tile, profile):
+        '''
+        Pack a tile as tif into the current shard.
+        '''
+        import time
+        
+        key = _make_sample_key(file_name, scale)
+        tile_bytes = encode_feature_tile(feature_tile, profile)
+        reference = self.add_member(key, f"{key}.{feature}.{scale}.tif", tile_bytes)
+        
+        image_info_dict = {
+            "timestamp_created": time.time(),
+            "format": "GTiff",
+            "file_size": len(tile_bytes),
+            "pixel_size": (feature_tile.shape[2], feature_tile.shape[1]),
+            "mode": feature_tile.dtype.name
+        }
+        return reference, image_info_dict
+    
+    
+    def find_tile(self, file_name, feature, scale):
+        '''
+        Return the reference of a tile, if it is in one of the shards (by
+        the shard index).
+        '''
+        import csv
+        
+        if self.member_shards is None:
+            member_shards = {}
+            if os.path.exists(self.index_file_name):
+                with open(self.index_file_name, "r") as index_file:
+                    member_shards.update((row["member"], row["shard"])
+                                         for row in csv.DictReader(index_file))
+            self.member_shards = member_shards
+        member_name = f"{_make_sample_key(file_name, scale)}.{feature}.{scale}.tif"
+        shard_path = self.member_shards.get(member_name)
+        return None if shard_path is None else f"{shard_path}::{member_name}"
+    
+    
+    def write_row(self, manipulation_dict, csv_row_dict):
+        '''
+        Pack the metadata row of a tile as json next to it.
+        '''
+        import json
+        
+        member_name = manipulation_dict["file_path"].split("::")[-1]
+        key = member_name.split(".")[0]
+        metadata_dict = {
+            **csv_row_dict,
+            "crs": manipulation_dict.get("crs", "NA"),
+            "transform": manipulation_dict.get("transform", "NA")
+        }
+        self.add_member(key, member_name.replace(".tif", ".json"),
+                        json.dumps(metadata_dict, default=str).encode())
+        return
+    
+    
+    def __getstate__(self):
+        '''
+        Drop the open shard when pickled, a new one is opened on the next write.
+        '''
+        state = self.__dict__.copy()
+        state["shard"] = None
+        state["shard_path"] = None
+        return state
+    
+    
+    def close(self):
+        '''
+        Close the current shard.
+        '''
+        if self.shard is not None:
+            self.shard.close()
+        self.shard = None
+        return
+# end TarShardSink
+
+
+class MemorySink(AbstractSink):
+    '''
+    Sink keeping the tiles of the last stitched location in memory, so they
+    can be handed over directly (e.g. to a model).
+    
+    Optionally the tiles are passed on to another sink, which stores them.
+    '''
+    def __init__(self, sink=None, silent=True):
+        '''
+        Construct with an optional sink, that also stores the tiles.
+        '''
+        super().__init__(silent=silent)
+        self.sink = sink
+        self.tiles = {}
+        self.entries = []
+        return
+    
+    
+    def write_tile(self, file_name, feature, scale, feature_tile, profile):
+        '''
+        Keep a tile in memory (and store it with the passed on sink).
+        '''
+        import time
+        
+        self.tiles[(feature, scale)] = feature_tile
+        self.entries.append((file_name, feature, scale, feature_tile, profile))
+        if self.sink is not None:
+            return self.sink.write_tile(file_name, feature, scale, feature_tile, profile)
+        
+        image_info_dict = {
+            "timestamp_created": time.time(),
+            "format": "ndarray",
+            "file_size": feature_tile.nbytes,
+            "pixel_size": (feature_tile.shape[2], feature_tile.shape[1]),
+            "mode": feature_tile.dtype.name
+        }
+        return f"memory::{feature}/{scale}", image_info_dict
+    
+    
+    def pop_tiles(self):
+        '''
+        Return the tiles kept in memory (by feature and scale) and release them.
+        '''
+        tiles = self.tiles
+        self.tiles = {}
+        self.entries = []
+        return tiles
+    
+    
+    def pop_entries(self):
+        '''
+        Return the arguments of all writes since the last release (to pass
+        them on to another sink later) and release them.
+        '''
+        entries = self.entries
+        self.pop_tiles()
+        return entries
+# end MemorySink
+
+
+class SynchronizedSink(AbstractSink):
+    '''
+    Sink passing the tiles on to another sink, one thread at a time.
+    '''
+    def __init__(self, sink, lock, silent=True):
+        '''
+        Construct with the sink and the lock shared by all threads.
+        '''
+        super().__init__(silent=silent)
+        self.sink = sink
+        self.lock = lock
+        return
+    
+    
+    def write_tile(self, file_name, feature, scale, feature_tile, profile):
+        with self.lock:
+            return self.sink.write_tile(file_name, feature, scale, feature_tile, profile)
+    
+    
+    def find_tile(self, file_name, feature, scale):
+        with self.lock:
+            return self.sink.find_tile(file_name, feature, scale)
+    
+    
+    def write_row(self, manipulation_dict, csv_row_dict):
+        with self.lock:
+            return self.sink.write_row(manipulation_dict, csv_row_dict)
+    
+    
+    def close(self):
+        with self.lock:
+            return self.sink.close()
+# end SynchronizedSink
+
+
+def make_sink(output_format, database_dir, compression=None, shard_size=None,
+              silent=True):
+    '''
+    Construct the sink for an output format in a database directory.
+    '''
+    if output_format not in OUTPUT_FORMATS:
+        raise RuntimeError(
+            f"Attention: Output format `{output_format}` is not "
+            f"implemented. Use one of those: {OUTPUT_FORMATS}")
+    if output_format == "geotiff":
+        return GeoTiffSink(silent=silent)
+    if output_format == "tar":
+        shard_kwargs = {} if shard_size is None else {"shard_size": shard_size}
+        return TarShardSink(os.path.join(database_dir, "shards"), silent=silent,
+                            **shard_kwargs)
+    extension = "zarr" if output_format == "zarr" else "h5"
+    return ArrayStoreSink(os.path.join(database_dir, f"tiles.{extension}"),
+                          store_format=output_format, compression=compression,
+                          silent=silent)
+
+
+def write_feature_tile(file_path, feature_tile, profile):
+    '''
+    Store the bands of a feature as georeferenced tif.
+    '''
+    import rasterio
+
+    with rasterio.open(file_path, "w", **_make_tif_kwargs(feature_tile, profile)) as file:
+        file.write(feature_tile)
+    return
+
+
+def encode_feature_tile(feature_tile, profile):
+    '''
+    Encode the bands of a feature as georeferenced tif in memory and return
+    the bytes.
+    '''
+    from rasterio.io import MemoryFile
+
+    with MemoryFile() as memory_file:
+        with memory_file.open(**_make_tif_kwargs(feature_tile, profile)) as file:
+            file.write(feature_tile)
+        tile_bytes = memory_file.read()
+    return tile_bytes
+
+
+# helpers
+def _make_tif_kwargs(feature_tile, profile):
+    '''
+    Adjust a profile to the bands and dtype of a feature tile.
+    '''
+    import numpy as np
+
+    kwargs = profile.copy()
+    kwargs["driver"] = "GTiff"
+    kwargs["count"] = feature_tile.shape[0]
+    kwargs["dtype"] = feature_tile.dtype.name
+    # spectral indices are stored as floats with nan as nodata
+    if np.issubdtype(feature_tile.dtype, np.floating):
+        kwargs["nodata"] = np.nan
+    kwargs["photometric"] = "RGB" if kwargs["count"] == 3 else "Grayscale"
+    return kwargs
+
+
+def _make_sample_key(file_name, scale):
+    '''
+    Derive the key of a location from a tile file name (without scale suffix).
+    
+    Dots are replaced, as webdataset splits keys and extensions at them.
+    '''
+    key = os.path.splitext(os.path.basename(file_name))[0]
+    if key.endswith(f"_{scale}"):
+        key = key[:-len(scale)-1]
+    return key.replace(".", "_")
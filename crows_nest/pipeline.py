@@ -0,0 +1,169 @@
+# here one can find the staged pipeline, which overlaps the steps of
+# the datamining (e.g. downloading, stitching and writing) for
+# multiple locations.
+import queue
+import threading
+
+# marks the end of the items in a queue
+_END_OF_ITEMS = object()
+# takes the place of items, that failed or were not passed on by a stage
+_DROPPED = object()
+
+
+## classes ##
+class PipelineStage:
+    '''
+    Step of a pipeline, which applies a function with a number of
+    workers to the items of its input queue.
+    '''
+    def __init__(self, name, function, workers=1):
+        '''
+        Construct with a name, the function applied to each item and the
+        number of concurrent workers.
+        
+        The function returns the item for the next stage (or None, if
+        there is nothing to pass on).
+        '''
+        assert workers > 0, f"The stage `{name}` needs at least one worker."
+        self.name = name
+        self.function = function
+        self.workers = workers
+        return
+# end PipelineStage
+
+
+class StagedPipeline:
+    '''
+    Pipeline of stages connected by bounded queues.
+    
+    All stages run concurrently in threads, so downloads (I/O) and
+    stitching (mostly in numpy/GDAL, which release the GIL) overlap.
+    As the queues are bounded, fast stages are blocked by slow ones
+    (backpressure) and memory stays constant.
+    
+    If `ordered`, the last stage (a single worker) receives the items in
+    the order they were given, e.g. to write metadata in order. Items
+    arriving early wait for their turn, but no further items are taken in
+    while the pipeline is full, so a slow item cannot make them pile up.
+    '''
+    def __init__(self, stages, queue_size=8, ordered=False, silent=True):
+        '''
+        Construct with a list of stages and the maximal number of items
+        waiting in front of each stage.
+        '''
+        assert len(stages) > 0, "A pipeline needs at least one stage."
+        assert not ordered or stages[-1].workers == 1, (
+            "Ordered items need a single worker in the last stage.")
+        self.stages = stages
+        self.queue_size = queue_size
+        self.ordered = ordered
+        self.silent = silent
+        return
+    
+    
+    def run(self, items):
+        '''
+        Pass all items through the stages and wait until they are processed.
+        
+        Items that fail in a stage are dropped and the first error is
+        raised after the pipeline is drained.
+        '''
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in self.stages]
+        errors = []
+        threads = []
+        # items in the queues, in the workers or waiting for their turn
+        in_flight = threading.Semaphore(
+            self.queue_size*len(self.stages) + sum(stage.workers for stage in self.stages))
+        for stage_index, stage in enumerate(self.stages):
+            output_queue = (queues[stage_index + 1] if stage_index + 1 < len(self.stages)
+                            else None)
+            # the last worker of a stage to finish tells the next stage
+            finished_workers = [0]
+            lock = threading.Lock()
+            for _ in range(stage.workers):
+                thread = threading.Thread(
+                    target=self.work, name=f"{stage.name}-worker",
+                    args=(stage, queues[stage_index], output_queue,
+                          errors, finished_workers, lock, in_flight),
+                    daemon=True)
+                thread.start()
+                threads.append(thread)
+        
+        # the first queue is filled while the stages work (with backpressure).
+        # items are numbered to restore their order.
+        for sequence_number, item in enumerate(items):
+            in_flight.acquire()
+            queues[0].put((sequence_number, item))
+        for _ in range(self.stages[0].workers):
+            queues[0].put(_END_OF_ITEMS)
+        
+        for thread in threads:
+            thread.join()
+        if len(errors) > 0:
+            stage_name, err = errors[0]
+            if not self.silent : print(
+                f"{len(errors)} item(s) failed in the pipeline.")
+            raise RuntimeError(
+                f"The pipeline stage `{stage_name}` failed with: {err!r}") from err
+        return
+    
+    
+    def work(self, stage, input_queue, output_queue, errors, finished_workers, lock,
+             in_flight):
+        '''
+        Process the items of a queue until its end is reached. The last stage
+        makes room for new items (`in_flight`).
+        '''
+        # items arriving too early are kept until their turn (ordered mode)
+        waiting_items = {}
+        next_sequence_number = 0
+        
+        while True:
+            queued_item = input_queue.get()
+            if queued_item is _END_OF_ITEMS:
+                break
+            if not (self.ordered and output_queue is None):
+                ready_items = [queued_item]
+            else:
+                waiting_items[queued_item[0]] = queued_item[1]
+                ready_items = []
+                while next_sequence_number in waiting_items:
+                    ready_items.append((next_sequence_number,
+                                        waiting_items.pop(next_sequence_number)))
+                    next_sequence_number += 1
+            
+            for sequence_number, item in ready_items:
+                result = self.process(stage, item, errors)
+                if output_queue is not None:
+                    # dropped items are still passed on to keep the order
+                    output_queue.put((sequence_number, result))
+                else:
+                    in_flight.release()
+        
+        # the next stage ends, when all workers of this stage ended
+        with lock:
+            finished_workers[0] += 1
+            last_worker = finished_workers[0] == stage.workers
+        if last_worker and output_queue is not None:
+            for _ in range(self.stages[self.stages.index(stage) + 1].workers):
+                output_queue.put(_END_OF_ITEMS)
+        return
+    
+    
+    def process(self, stage, item, errors):
+        '''
+        Apply the function of a stage to an item.
+        
+        Failing items are dropped, but the pipeline keeps on draining.
+        '''
+        if item is _DROPPED:
+            return _DROPPED
+        try:
+            result = stage.function(item)
+        except Exception as err:
+            errors.append((stage.name, err))
+            if not self.silent : print(
+                f"Error in the pipeline stage `{stage.name}`: {err}")
+            return _DROPPED
+        return _DROPPED if result is None else result
+# end StagedPipeline
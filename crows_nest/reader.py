@@ -1,9 +1,12 @@
 from abc import ABCMeta
 from abc import abstractmethod
 import os
+import tempfile
+import threading
 import urllib
 
 from utils import download_to_path
+from utils import make_directory
 
 
 class AbstractReader(metaclass=ABCMeta):
@@ -59,28 +62,48 @@ class RemoteReader(AbstractReader):
             dest_file_path = self.destination.make_dest_file_path(
                 self.dataminer.get_local_src_dest_path(source_file_query))
 
-        # try the fetch
-        if self.destination.prepare_filepath(dest_file_path, force=force):
-            #try:
-            file_xr = self.dataminer.cat(path_base=self.url, filename=source_file_query)
-            #    print(file_xr, dest_file_path)
-            #    file_xr.to_dask().rio.to_raster(dest_file_path)
-            #    header = None
-            # except ValueError:
-            try:
-                fp, header = urllib.request.urlretrieve(file_xr.urlpath, dest_file_path)
-            except (HTTPError, URLError) as err:
-                if not self.silent : print(
-                    f"The download of `{source_file_url}` failed with {err}.")
-                csv_dict = None
+        # try the fetch, each tile is downloaded once by the threads of a process
+        with _get_download_lock(dest_file_path):
+            if self.destination.prepare_filepath(dest_file_path, force=force):
+                #try:
+                file_xr = self.dataminer.cat(path_base=self.url, filename=source_file_query)
+                #    print(file_xr, dest_file_path)
+                #    file_xr.to_dask().rio.to_raster(dest_file_path)
+                #    header = None
+                # except ValueError:
+                # the download goes to a unique partial file, which is renamed
+                # when complete. so workers sharing the cache never read half
+                # written tiles.
+                partial_file_descriptor, partial_file_path = tempfile.mkstemp(
+                    suffix=".part", dir=os.path.dirname(dest_file_path))
+                os.close(partial_file_descriptor)
+                os.chmod(partial_file_path, 0o644)
+                metrics = self.dataminer.metrics
+                try:
+                    with metrics.time_stage("download"):
+                        fp, header = urllib.request.urlretrieve(file_xr.urlpath, partial_file_path)
+                except (HTTPError, URLError) as err:
+                    if not self.silent : print(
+                        f"The download of `{source_file_url}` failed with {err}.")
+                    metrics.count("fetch_errors_total", tier="remote")
+                    csv_dict = None
+                else:
+                    os.replace(partial_file_path, dest_file_path)
+                    metrics.count("fetch_files_total", tier="remote")
+                    metrics.count("fetch_bytes_total", os.path.getsize(dest_file_path), tier="remote")
+                    csv_dict = self.dataminer.make_csv_row(met_assembler_csv, query_url=source_file_url,
+                        file_name=dest_file_path, meta_information_dict=header)
+                    if not self.silent : print(
+                        f"Data from `{source_file_url}` was retrieved to `{dest_file_path}`.")
+                finally:
+                    # failed downloads leave no partial file behind
+                    if os.path.exists(partial_file_path):
+                        os.remove(partial_file_path)
+            # if preparation fails we do not document it
             else:
-                csv_dict = self.dataminer.make_csv_row(met_assembler_csv, query_url=source_file_url,
-                    file_name=dest_file_path, meta_information_dict=header)
-                if not self.silent : print(
-                    f"Data from `{source_file_url}` was retrieved to `{dest_file_path}`.")
-        # if preparation fails we do not document it
-        else:
-            csv_dict = None
+                # the file is in the cache already
+                self.dataminer.metrics.count("fetch_files_total", tier="cache")
+                csv_dict = None
         return dest_file_path, csv_dict
     
     
@@ -181,22 +204,31 @@ class LocalReader(AbstractReader):
             # do not download if dest_file already exists and prepare directories
             if self.destination.prepare_filepath(dest_file_path, force=force):
                 if self.copy_local:
+                    # registers the `rio` accessor of xarray (imported on use, as it is slow)
+                    import rioxarray
+                    
                     try:
-                        file_xr = self.dataminer.cat(path_base=self.destination.cache_dir, file_name=path_base)
-                        file_xr.to_dask().rio.rio.to_raster(dest_file_path)
+                        with self.dataminer.metrics.time_stage("copy_local"):
+                            file_xr = self.dataminer.cat(path_base=self.destination.cache_dir, file_name=path_base)
+                            file_xr.to_dask().rio.rio.to_raster(dest_file_path)
                     except:
                         if not self.silent : print(
                             f"The copy process of `{source_file_path}` from LocalReader failed.")
+                        self.dataminer.metrics.count("fetch_errors_total", tier="local")
                         csv_row = None
                     else:
+                        self.dataminer.metrics.count("fetch_files_total", tier="local")
                         csv_row = self.copy_csv_row(source_file_path, dest_file_path=dest_file_path) # TODO
                         if not self.silent : print(
                             f"Local data from `{source_file_path}` was copied to `{dest_file_path}`.")
             # for (1) existing files or (2) no `copy_local` flag,
             # we just use the same header.
                 else: 
+                    self.dataminer.metrics.count("fetch_files_total", tier="local")
                     csv_row = self.copy_csv_row(source_file_path) # TODO
             else: 
+                # the file is in the cache already
+                self.dataminer.metrics.count("fetch_files_total", tier="cache")
                 csv_row = None # TODO
             
             # building the csv dict from the simple row
@@ -342,13 +374,15 @@ class LocalDest:
         
         # do not download if file already exists
         if (not os.path.exists(dest_file_path) or force):
-            # create parent directories if they are not existent
+            # create parent directories if they are not existent (once)
             parent_dir = os.path.dirname(dest_file_path)
-            if not os.path.exists(parent_dir):
-                os.makedirs(parent_dir)
-                if not self.silent : print(
-                    f"Path to `{dest_file_path}` was prepared for file download.")
+            made = make_directory(parent_dir)
+            # the directory may have been removed since (e.g. by a cleanup)
+            if not made and not os.path.exists(parent_dir):
+                made = make_directory(parent_dir, force=True)
             assert os.path.exists(parent_dir), path_not_made_msg(parent_dir)
+            if made and not self.silent : print(
+                f"Path to `{dest_file_path}` was prepared for file download.")
             return True
         
         else:
@@ -362,4 +396,20 @@ class LocalDest:
         Build a destination filepath for a query of a specified cache file.
         '''
         dest_file_path = os.path.join(self.cache_dir, rel_source_file_path)
-        return dest_file_path
\ No newline at end of file
+        return dest_file_path
+
+
+# helpers
+# fixed number of locks shared by the destination files of downloads
+_NUMBER_OF_DOWNLOAD_LOCKS = 256
+_DOWNLOAD_LOCKS = [threading.Lock() for _ in range(_NUMBER_OF_DOWNLOAD_LOCKS)]
+
+def _get_download_lock(dest_file_path):
+    '''
+    Return the lock of a destination file (chosen by the hash of its path),
+    so threads downloading the same tile wait for each other (and the later
+    ones find it in the cache). Rarely unrelated tiles share a lock.
+    '''
+    import zlib
+    
+    return _DOWNLOAD_LOCKS[zlib.crc32(dest_file_path.encode()) % _NUMBER_OF_DOWNLOAD_LOCKS]
@@ -0,0 +1,120 @@
+# here one can find the journal of a run, which records the state of each
+# location, so an interrupted run can be resumed without redoing (or
+# re-checking) finished locations.
+import json
+import os
+import threading
+
+# the states a location passes through in a run
+JOURNAL_STATES = ["planned", "fetched", "written", "failed"]
+
+
+## classes ##
+class RunJournal:
+    '''
+    Append-only journal (JSONL) of the states of the locations of a run.
+    
+    Each line records the index, key (coordinates and date) and the new
+    state of a location (and the reason of failures). When opened again,
+    the last state of each location is restored, so a resumed run only
+    schedules the unfinished locations.
+    '''
+    def __init__(self, journal_path, silent=True):
+        '''
+        Construct with the path of the journal file, which is created or
+        continued.
+        '''
+        self.journal_path = journal_path
+        self.silent = silent
+        self.lock = threading.Lock()
+        
+        # the last state of each location by index
+        self.states = {}
+        self.keys = {}
+        if os.path.exists(journal_path):
+            self.load()
+        elif os.path.dirname(journal_path) != "":
+            os.makedirs(os.path.dirname(journal_path), exist_ok=True)
+        self.journal_file = open(journal_path, "a")
+        # a line cut off by a crash is ended, so it does not spoil the next one
+        if self.journal_file.tell() > 0:
+            with open(journal_path, "rb") as journal_file:
+                journal_file.seek(-1, os.SEEK_END)
+                if journal_file.read(1) != b"\n":
+                    self.journal_file.write("\n")
+        return
+    
+    
+    def load(self):
+        '''
+        Restore the last state of each location from the journal file.
+        '''
+        with open(self.journal_path, "r") as journal_file:
+            for line in journal_file:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # the last line may be cut off by a crash
+                    continue
+                self.states[entry["index"]] = entry["state"]
+                self.keys[entry["index"]] = entry["key"]
+        if not self.silent : print(
+            f"The journal `{self.journal_path}` was loaded: {self.get_summary()}")
+        return
+    
+    
+    def record(self, index, key, state, reason=None):
+        '''
+        Append the new state of a location to the journal.
+        '''
+        assert state in JOURNAL_STATES, (
+            f"The state `{state}` is unknown. Use one of those: {JOURNAL_STATES}")
+        entry = {"index": index, "key": key, "state": state}
+        if reason is not None:
+            entry["reason"] = reason
+        with self.lock:
+            self.journal_file.write(json.dumps(entry) + "\n")
+            self.journal_file.flush()
+            self.states[index] = state
+            self.keys[index] = key
+        return
+    
+    
+    def is_finished(self, index, key, retry_failed=False):
+        '''
+        Check if a location was already concluded (written, or failed unless
+        `retry_failed`) with the same key in a former run.
+        '''
+        finished_states = ["written"] if retry_failed else ["written", "failed"]
+        return self.keys.get(index) == key and self.states.get(index) in finished_states
+    
+    
+    def get_summary(self):
+        '''
+        Return the number of locations in each state.
+        '''
+        summary = {state: 0 for state in JOURNAL_STATES}
+        for state in self.states.values():
+            summary[state] += 1
+        return summary
+    
+    
+    def close(self):
+        '''
+        Write the journal to disk and close it.
+        '''
+        with self.lock:
+            if not self.journal_file.closed:
+                self.journal_file.flush()
+                os.fsync(self.journal_file.fileno())
+                self.journal_file.close()
+        return
+# end RunJournal
+
+
+def make_location_key(location, date_given):
+    '''
+    Return the key of a location and its date, which identifies it in the
+    journal.
+    '''
+    return f"{location.x:.7f},{location.y:.7f},{date_given}"
@@ -0,0 +1,229 @@
+# here one can find the metrics of a run, which count events (e.g. cache
+# hits) and collect the durations of its stages (e.g. fetching or
+# stitching), to find the bottlenecks of a run.
+from contextlib import contextmanager
+import threading
+import time
+
+# upper bounds (s) of the buckets of the duration histograms
+DURATION_BUCKETS = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1., 5., 10., 60.]
+
+# prefix of the metric names in the Prometheus text format
+METRICS_PREFIX = "crows_nest"
+
+
+## classes ##
+class RunMetrics:
+    '''
+    Thread-safe counters and duration histograms of the stages of a run.
+    
+    Counters are named and can carry labels (e.g. the cache tier of a
+    fetch). Metrics of worker processes are merged with `merge`. At the
+    end of a run they are exported as JSON and in the text format of
+    Prometheus.
+    '''
+    def __init__(self, progress_interval=None):
+        '''
+        Construct empty metrics. With a `progress_interval` (s) a progress
+        line is printed at most that often (see `report_progress`).
+        '''
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.durations = {}
+        self.start_time = time.time()
+        self.progress_interval = progress_interval
+        self.last_progress_time = self.start_time
+        return
+    
+    
+    def __getstate__(self):
+        '''
+        Drop the lock when pickled (e.g. for worker processes).
+        '''
+        state = self.__dict__.copy()
+        state.pop("lock")
+        return state
+    
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+        return
+    
+    
+    def count(self, name, value=1, **labels):
+        '''
+        Add a value to a counter (with the given labels).
+        '''
+        counter_key = _make_counter_key(name, labels)
+        with self.lock:
+            self.counters[counter_key] = self.counters.get(counter_key, 0) + value
+        return
+    
+    
+    def observe(self, stage, duration):
+        '''
+        Add the duration (s) of a stage to its histogram.
+        '''
+        with self.lock:
+            histogram = self.durations.setdefault(stage, _make_histogram())
+            _add_to_histogram(histogram, duration)
+        return
+    
+    
+    @contextmanager
+    def time_stage(self, stage):
+        '''
+        Measure the duration of the enclosed code as stage.
+        '''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+    
+    
+    def pop_metrics(self):
+        '''
+        Return the counters and histograms collected so far and reset them
+        (e.g. in a worker process).
+        '''
+        with self.lock:
+            metrics_dict = {"counters": self.counters, "durations": self.durations}
+            self.counters = {}
+            self.durations = {}
+        return metrics_dict
+    
+    
+    def merge(self, metrics_dict):
+        '''
+        Merge the counters and histograms of other metrics (see `pop_metrics`).
+        '''
+        with self.lock:
+            for counter_key, value in metrics_dict["counters"].items():
+                self.counters[counter_key] = self.counters.get(counter_key, 0) + value
+            for stage, other_histogram in metrics_dict["durations"].items():
+                histogram = self.durations.setdefault(stage, _make_histogram())
+                histogram["count"] += other_histogram["count"]
+                histogram["sum"] += other_histogram["sum"]
+                histogram["max"] = max(histogram["max"], other_histogram["max"])
+                histogram["buckets"] = [count + other_count for count, other_count
+                                        in zip(histogram["buckets"], other_histogram["buckets"])]
+        return
+    
+    
+    def report_progress(self, done, total=None, force=False):
+        '''
+        Print a progress line with throughput (and ETA, if the `total` number
+        of locations is known), if the progress interval passed.
+        '''
+        now = time.time()
+        if not force and (self.progress_interval is None or
+                          now - self.last_progress_time < self.progress_interval):
+            return
+        self.last_progress_time = now
+        elapsed = max(now - self.start_time, 1e-9)
+        throughput = done/elapsed
+        progress_line = (f"{done}{'' if total is None else f'/{total}'} locations "
+                         f"in {elapsed/60:.1f} min ({throughput:.2f} locations/s)")
+        if total is not None and throughput > 0:
+            progress_line += f", ETA {(total - done)/throughput/60:.1f} min"
+        print(progress_line)
+        return
+    
+    
+    def to_dict(self):
+        '''
+        Return the metrics as dictionary, with the mean duration of each stage.
+        '''
+        with self.lock:
+            durations = {stage: {**histogram,
+                                 "mean": histogram["sum"]/max(histogram["count"], 1)}
+                         for stage, histogram in self.durations.items()}
+            return {
+                "elapsed": time.time() - self.start_time,
+                "counters": dict(self.counters),
+                "durations": durations,
+                "bucket_bounds": DURATION_BUCKETS
+            }
+    
+    
+    def to_prometheus(self):
+        '''
+        Return the metrics in the text format of Prometheus.
+        '''
+        lines = []
+        with self.lock:
+            for counter_key, value in sorted(self.counters.items()):
+                lines.append(f"{METRICS_PREFIX}_{counter_key} {value}")
+            for stage, histogram in sorted(self.durations.items()):
+                metric_name = f"{METRICS_PREFIX}_stage_duration_seconds"
+                cumulative_count = 0
+                for bound, bucket_count in zip(DURATION_BUCKETS + ["+Inf"], histogram["buckets"]):
+                    cumulative_count += bucket_count
+                    lines.append(f'{metric_name}_bucket{{stage="{stage}",le="{bound}"}} '
+                                 f'{cumulative_count}')
+                lines.append(f'{metric_name}_sum{{stage="{stage}"}} {histogram["sum"]}')
+                lines.append(f'{metric_name}_count{{stage="{stage}"}} {histogram["count"]}')
+        return "\n".join(lines) + "\n"
+    
+    
+    def export(self, file_name_prefix, silent=True):
+        '''
+        Store the metrics as JSON and Prometheus text file next to each other.
+        '''
+        import json
+        
+        with open(f"{file_name_prefix}.json", "w") as json_file:
+            json.dump(self.to_dict(), json_file, indent=2)
+        with open(f"{file_name_prefix}.prom", "w") as prometheus_file:
+            prometheus_file.write(self.to_prometheus())
+        if not silent : print(
+            f"The metrics of the run were stored in `{file_name_prefix}.json` and "
+            f"`{file_name_prefix}.prom`.")
+        return
+# end RunMetrics
+
+
+@contextmanager
+def time_stage(metrics, stage):
+    '''
+    Measure the duration of a stage with the given metrics (nothing is
+    measured without metrics).
+    '''
+    if metrics is None:
+        yield
+        return
+    with metrics.time_stage(stage):
+        yield
+
+
+# helpers
+def _make_counter_key(name, labels):
+    '''
+    Return the key of a counter in the Prometheus notation (`name{label="value"}`).
+    '''
+    if len(labels) == 0:
+        return name
+    label_text = ",".join(f'{label}="{value}"' for label, value in sorted(labels.items()))
+    return f"{name}{{{label_text}}}"
+
+
+def _make_histogram():
+    '''
+    Return an empty duration histogram.
+    '''
+    return {"count": 0, "sum": 0., "max": 0., "buckets": [0]*(len(DURATION_BUCKETS) + 1)}
+
+
+def _add_to_histogram(histogram, duration):
+    '''
+    Add a duration to a histogram (the last bucket holds the longer ones).
+    '''
+    import bisect
+    
+    histogram["count"] += 1
+    histogram["sum"] += duration
+    histogram["max"] = max(histogram["max"], duration)
+    histogram["buckets"][bisect.bisect_left(DURATION_BUCKETS, duration)] += 1
+    return
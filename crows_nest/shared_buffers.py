@@ -0,0 +1,156 @@
+# here one can find the shared memory buffers, which hand over tiles
+# between processes without pickling (and copying) their pixels.
+import queue
+import sys
+
+# offsets of arrays in a slab are aligned to this many bytes
+SLAB_ALIGNMENT = 64
+
+# slabs attached by this process, by name (see `attach_slab`)
+_ATTACHED_SLABS = {}
+
+
+## classes ##
+class SharedSlabPool:
+    '''
+    Fixed number of equally sized shared memory slabs, which are handed
+    out to worker processes and recycled.
+    
+    A worker writes the tiles of one location into a slab and returns
+    handles (offset, shape, dtype), which are viewed here without
+    copying. The slab is released once the tiles are stored, so the
+    memory used stays constant independent of the number of workers.
+    '''
+    def __init__(self, slab_size, number_of_slabs, silent=True):
+        '''
+        Construct and allocate `number_of_slabs` slabs of `slab_size` bytes.
+        '''
+        from multiprocessing import shared_memory
+        
+        self.silent = silent
+        self.slab_size = slab_size
+        self.slabs = [shared_memory.SharedMemory(create=True, size=slab_size)
+                      for _ in range(number_of_slabs)]
+        self.free_slabs = queue.Queue()
+        for slab_index in range(number_of_slabs):
+            self.free_slabs.put(slab_index)
+        if not self.silent : print(
+            f"{number_of_slabs} shared memory slabs of {slab_size} bytes were allocated.")
+        return
+    
+    
+    def acquire(self, block=False):
+        '''
+        Return the index of a free slab (None if there is no free one and
+        `block` is not set).
+        '''
+        try:
+            return self.free_slabs.get(block=block)
+        except queue.Empty:
+            return None
+    
+    
+    def release(self, slab_index):
+        '''
+        Return a slab to the free ones.
+        '''
+        self.free_slabs.put(slab_index)
+        return
+    
+    
+    def get_name(self, slab_index):
+        '''
+        Return the name of a slab, by which workers attach to it.
+        '''
+        return self.slabs[slab_index].name
+    
+    
+    def get_array(self, slab_index, handle):
+        '''
+        Return a view on an array in a slab given its handle.
+        '''
+        return view_array(self.slabs[slab_index], handle)
+    
+    
+    def close(self):
+        '''
+        Free the memory of all slabs.
+        '''
+        from multiprocessing import resource_tracker
+        
+        for slab in self.slabs:
+            # attaching processes sharing the tracker may have unregistered it
+            if sys.version_info < (3, 13):
+                resource_tracker.register(slab._name, "shared_memory")
+            slab.unlink()
+            try:
+                slab.close()
+            except BufferError:
+                pass  # remaining views keep the memory until they are gone
+        self.slabs = []
+        return
+# end SharedSlabPool
+
+
+class SlabWriter:
+    '''
+    Writer placing arrays one after another in a slab (in a worker process).
+    '''
+    def __init__(self, slab_name):
+        '''
+        Construct with the name of the slab to write to.
+        '''
+        self.slab = attach_slab(slab_name)
+        self.offset = 0
+        return
+    
+    
+    def put(self, array):
+        '''
+        Copy an array into the slab and return its handle (None if the
+        slab is full).
+        '''
+        offset = -(-self.offset//SLAB_ALIGNMENT)*SLAB_ALIGNMENT
+        if offset + array.nbytes > self.slab.size:
+            return None
+        handle = (offset, array.shape, array.dtype.str)
+        view_array(self.slab, handle)[...] = array
+        self.offset = offset + array.nbytes
+        return handle
+# end SlabWriter
+
+
+def attach_slab(slab_name):
+    '''
+    Attach to a slab by its name, once per process.
+    '''
+    if slab_name not in _ATTACHED_SLABS:
+        _ATTACHED_SLABS[slab_name] = _open_untracked_slab(slab_name)
+    return _ATTACHED_SLABS[slab_name]
+
+
+def view_array(slab, handle):
+    '''
+    Return an array viewing the memory of a slab at the given handle.
+    '''
+    import numpy as np
+    
+    offset, shape, dtype = handle
+    return np.ndarray(shape, dtype=dtype, buffer=slab.buf, offset=offset)
+
+
+# helpers
+def _open_untracked_slab(slab_name):
+    '''
+    Open an existing slab without handing it to the resource tracker, which
+    would otherwise unlink (or warn about) the slab when an attaching
+    process exits; only the pool creating a slab unlinks it.
+    '''
+    from multiprocessing import shared_memory
+    
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=slab_name, track=False)
+    from multiprocessing import resource_tracker
+    slab = shared_memory.SharedMemory(name=slab_name)
+    resource_tracker.unregister(slab._name, "shared_memory")
+    return slab
@@ -4,18 +4,20 @@ import os
 import shapely
 import urllib
 
+# directories created (or found) by this process in the current run, see
+# `make_directory`
+_MADE_DIRECTORIES = set()
+
 # helper for shapely initialization of coordinates
-def set_locations(longitudes, latitudes):
+def set_locations(longitudes, latitudes, dates=None):
     '''
-    Create a list of shapely points for each pair of coordinates (longitude, latitude).
+    Create a container of locations for each pair of coordinates (longitude, latitude).
+
+    The container is backed by arrays and yields shapely points on access.
     '''
-    LENGTH_ERR_MSG = (
-        "The lists for latitudes ({len(longitudes)}) and "
-        f"lon ({len(longitudes)}) have unequal length. Please adjust.")
+    from location_plan import Locations
 
-    assert len(longitudes) == len(latitudes), LENGTH_ERR_MSG
-    locations = [shapely.geometry.point.Point((lon, lat)) for lon, lat in zip(
-        longitudes, latitudes)]
+    locations = Locations(longitudes, latitudes, dates)
 
     return locations
 
@@ -36,6 +38,47 @@ def set_directory(directory=None, database_name="data_barrel"):
 
     return root
 
+# helper to create directories once
+def make_directory(directory, force=False):
+    '''
+    Create a directory (and its parents), unless this process created or
+    found it before in the current run (or with `force`). This saves the
+    stat and mkdir calls for each file.
+    
+    Returns True if the directory was not known before.
+    '''
+    if directory in _MADE_DIRECTORIES and not force:
+        return False
+    # other workers may create the directory meanwhile
+    os.makedirs(directory, exist_ok=True)
+    _MADE_DIRECTORIES.add(directory)
+    return True
+
+# helper to forget the directories made, e.g. when a run starts
+def reset_made_directories():
+    '''
+    Forget the directories made so far, so directories removed meanwhile
+    (e.g. by a cache cleanup) are created again.
+    '''
+    _MADE_DIRECTORIES.clear()
+    return
+
+# helper to spread many files over nested directories
+def make_fan_out_path(file_path, levels=2, width=2):
+    '''
+    Insert `levels` directories named by the leading `width` characters
+    of the hash of the file name before it (e.g. `dir/3f/a2/name`), so no
+    directory holds too many files.
+    '''
+    import hashlib
+
+    if levels == 0:
+        return file_path
+    directory, file_name = os.path.split(file_path)
+    digest = hashlib.sha1(file_name.encode()).hexdigest()
+    fan_out_dirs = [digest[level*width:(level + 1)*width] for level in range(levels)]
+    return "/".join([directory] + fan_out_dirs + [file_name])
+
 # helper to download a file from url and store it in a given path
 def download_to_path(url, file_path,
         force=False, silent=True, local_path=False):
@@ -152,6 +195,51 @@ def write_csv_row(filename, row_dictionary):
             csv_writer.writerow(row_dictionary)
     return
         
+# csv files of former versions lack newer columns, they are extended
+def migrate_csv_header(filename, header, fill_value="NA"):
+    '''
+    Add the columns of a header, which an existing csv file lacks, filled
+    with `fill_value` in its rows.
+    
+    Files with unknown columns are left as they are. Returns True if the
+    file was migrated.
+    '''
+    import csv
+    
+    if not os.path.exists(filename):
+        return False
+    with open(filename, "r") as csv_file:
+        csv_reader = csv.DictReader(csv_file)
+        file_header = csv_reader.fieldnames or []
+        if sorted(file_header) == sorted(header) or not set(file_header) <= set(header):
+            return False
+        rows = list(csv_reader)
+    # the migrated file replaces the old one at once
+    migrated_filename = f"{filename}.{os.getpid()}.migrated"
+    with open(migrated_filename, "w") as csv_file:
+        csv_writer = csv.DictWriter(csv_file, fieldnames=list(header), restval=fill_value)
+        csv_writer.writeheader()
+        csv_writer.writerows(rows)
+    os.replace(migrated_filename, filename)
+    return True
+
+# rows of reused outputs are found again in the csv files
+def find_csv_rows(filename, column, values):
+    '''
+    Return the rows (as dictionaries) of a csv file with one of the values
+    in a column, listed by value. Values without rows are left out.
+    '''
+    import csv
+    
+    found_rows = {}
+    if not os.path.exists(filename):
+        return found_rows
+    with open(filename, "r") as csv_file:
+        for row in csv.DictReader(csv_file):
+            if row[column] in values:
+                found_rows.setdefault(row[column], []).append(row)
+    return found_rows
+
 # helper for meta information files that track database requests etc.
 def make_csv_path(base_path, database_name):
     '''
@@ -0,0 +1,6 @@
+# the modules of crows_nest import each other by name (they are run from
+# within its directory), so it is put on the path for the tests.
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(__file__)), "crows_nest"))
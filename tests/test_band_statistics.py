@@ -0,0 +1,54 @@
+# tests of the running band statistics, which are merged over tiles and workers.
+import numpy as np
+
+from image_manipulation import BandStatistics
+
+
+def make_statistics(band_array, valid):
+    statistics = BandStatistics(band_array.shape[0], band_array.dtype)
+    statistics.update(band_array, valid)
+    return statistics
+
+
+def test_update_matches_numpy():
+    rng = np.random.default_rng(0)
+    band_array = rng.integers(0, 256, size=(3, 16, 16), dtype="uint8")
+    valid = rng.random((16, 16)) > 0.25
+    statistics = make_statistics(band_array, valid)
+    
+    values = band_array[:, valid].astype("float64")
+    assert statistics.count == valid.sum()
+    np.testing.assert_allclose(statistics.mean, values.mean(axis=1))
+    np.testing.assert_allclose(statistics.get_std(), values.std(axis=1))
+    assert statistics.get_nodata_fraction() == (~valid).sum()/valid.size
+    assert statistics.histograms.sum(axis=1).tolist() == [valid.sum()]*3
+
+
+def test_merge_equals_update_of_all_tiles():
+    rng = np.random.default_rng(1)
+    tiles = [rng.integers(0, 256, size=(2, 8, 8), dtype="uint8") for _ in range(3)]
+    valids = [rng.random((8, 8)) > 0.5 for _ in range(3)]
+    # a tile without valid pixels only adds nodata
+    valids[1][:] = False
+    
+    merged = BandStatistics(2, "uint8")
+    for tile, valid in zip(tiles, valids):
+        merged.merge(make_statistics(tile, valid))
+    combined = make_statistics(np.concatenate(tiles, axis=2), np.concatenate(valids, axis=1))
+    
+    assert merged.count == combined.count
+    assert merged.pixels == combined.pixels
+    assert merged.nodata_pixels == combined.nodata_pixels
+    np.testing.assert_allclose(merged.mean, combined.mean)
+    np.testing.assert_allclose(merged.get_std(), combined.get_std())
+    np.testing.assert_array_equal(merged.histograms, combined.histograms)
+
+
+def test_empty_statistics():
+    statistics = BandStatistics(2, "uint8")
+    statistics.merge(BandStatistics(2, "uint8"))
+    
+    assert statistics.count == 0
+    assert np.isnan(statistics.get_std()).all()
+    assert statistics.get_nodata_fraction() == 1.
+    assert statistics.to_dict()["count"] == 0
@@ -0,0 +1,59 @@
+# tests of the plan of a run (ids, repeated locations and spatial order).
+from datetime import date
+
+import numpy as np
+from shapely.geometry import Point
+
+from location_plan import LOCATION_ID_WIDTH
+from location_plan import LocationPlan
+from location_plan import LocationStream
+from location_plan import Locations
+from location_plan import make_location_id
+
+
+def test_make_location_id():
+    assert make_location_id(0) == "loc_0000000001"
+    assert len(make_location_id(12345)) == len("loc_") + LOCATION_ID_WIDTH
+
+
+def test_repeated_locations_share_a_key():
+    points = [Point(1, 1), Point(2, 2), Point(1, 1), Point(1, 1)]
+    dates = [date(2020, 1, 1), date(2020, 1, 1), date(2020, 1, 1), date(2021, 1, 1)]
+    plan = LocationPlan(points, dates)
+    
+    assert len(plan) == 4
+    assert plan.number_of_duplicates == 1
+    assert [plan.get_first_index(index) for index in range(4)] == [0, 1, 0, 3]
+    deduplicated = sorted(index for index, _, _ in plan.iter_tasks(deduplicate=True))
+    assert deduplicated == [0, 1, 3]
+    location, date_given = plan.get_task(3)
+    assert (location.x, location.y, date_given) == (1, 1, date(2021, 1, 1))
+
+
+def test_spatial_order_covers_all_locations():
+    rng = np.random.default_rng(0)
+    locations = Locations(rng.uniform(-120, -70, 100), rng.uniform(25, 50, 100))
+    plan = LocationPlan(locations)
+    
+    spatial_indices = [index for index, _, _ in plan.iter_tasks()]
+    assert sorted(spatial_indices) == list(range(100))
+    input_indices = [index for index, _, _ in plan.iter_tasks(spatial_order=False)]
+    assert input_indices == list(range(100))
+
+
+def test_stream_ids_match_the_ones_of_a_list():
+    points = [Point(x, 40) for x in range(7)]
+    plan = LocationPlan(points)
+    stream = LocationStream.from_iterable(iter(points), chunk_size=3)
+    
+    stream_tasks = [(index, plan.get_location_id(index), location.x)
+                    for index, location, _ in stream.iter_tasks(spatial_order=False)]
+    assert stream_tasks == [(index, make_location_id(index), float(index))
+                            for index in range(7)]
+
+
+def test_plan_from_input_returns_a_given_plan():
+    plan = LocationPlan([Point(0, 0)])
+    
+    assert LocationPlan.from_input(plan) is plan
+    assert LocationStream.from_input(plan).total_number == 1
@@ -0,0 +1,53 @@
+# tests of the content keyed file names of the NAIP tiles.
+from shapely.geometry import Point
+
+from image_manipulation import FileStitcher
+from new_naip import NAIPData
+
+
+def make_dataminer(tile_size=100, pixel_size=None, stitch_mode="mosaic"):
+    # only the attributes naming the files are set, the database index is
+    # not needed
+    dataminer = object.__new__(NAIPData)
+    dataminer.tile_size = tile_size
+    dataminer.pixel_size = pixel_size
+    dataminer.tile_stitcher = FileStitcher(tile_size, ["rgb"], stitch_mode=stitch_mode)
+    dataminer.database_dir = "database"
+    dataminer.file_naming = "content"
+    dataminer.fan_out_levels = 0
+    return dataminer
+
+
+def test_content_key_depends_on_the_content_only():
+    dataminer = make_dataminer()
+    key = dataminer.make_content_key(Point(-100.5, 40.25), ["tile_b.tif", "tile_a.tif"])
+    
+    assert len(key) == 20
+    # the order of the source tiles and tiny float differences do not matter
+    assert key == dataminer.make_content_key(Point(-100.5, 40.25),
+                                             ["tile_a.tif", "tile_b.tif"])
+    assert key == dataminer.make_content_key(Point(-100.5 + 1e-9, 40.25),
+                                             ["tile_a.tif", "tile_b.tif"])
+
+
+def test_content_key_changes_with_the_tiles():
+    dataminer = make_dataminer()
+    location = Point(-100.5, 40.25)
+    key = dataminer.make_content_key(location, ["tile_a.tif"])
+    
+    assert key != dataminer.make_content_key(Point(-100.5, 40.26), ["tile_a.tif"])
+    assert key != dataminer.make_content_key(location, ["tile_c.tif"])
+    assert key != make_dataminer(tile_size=200).make_content_key(location, ["tile_a.tif"])
+    assert key != make_dataminer(pixel_size=50).make_content_key(location, ["tile_a.tif"])
+    assert key != make_dataminer(stitch_mode="cv2").make_content_key(location, ["tile_a.tif"])
+
+
+def test_file_name_of_content_naming():
+    dataminer = make_dataminer()
+    location = Point(-100.5, 40.25)
+    key = dataminer.make_content_key(location, ["tile_a.tif"])
+    
+    assert dataminer.make_file_name(3, 10, location, ["tile_a.tif"]) == (
+        f"database/FEATURE_PLACE_HOLDER/{key}")
+    # without a location the index names the file
+    assert dataminer.make_file_name(3, 10).endswith("_loc_0000000004")
@@ -0,0 +1,65 @@
+# tests of the staged pipeline (order of the items and draining on errors).
+import random
+import time
+
+import pytest
+
+from pipeline import PipelineStage
+from pipeline import StagedPipeline
+
+
+def sleep_randomly(item):
+    time.sleep(random.random()/500)
+    return item
+
+
+def test_ordered_pipeline_keeps_the_order():
+    written = []
+    pipeline = StagedPipeline([
+        PipelineStage("fetch", sleep_randomly, workers=4),
+        PipelineStage("stitch", sleep_randomly, workers=3),
+        PipelineStage("write", written.append)], queue_size=2, ordered=True)
+    pipeline.run(range(50))
+    
+    assert written == list(range(50))
+
+
+def test_unordered_pipeline_processes_all_items():
+    written = []
+    pipeline = StagedPipeline([
+        PipelineStage("fetch", sleep_randomly, workers=4),
+        PipelineStage("write", written.append, workers=2)], queue_size=2)
+    pipeline.run(iter(range(30)))
+    
+    assert sorted(written) == list(range(30))
+
+
+def test_failing_items_are_dropped_and_the_pipeline_drains():
+    written = []
+    def fetch(item):
+        if item % 5 == 0:
+            raise KeyError(item)
+        return sleep_randomly(item)
+    pipeline = StagedPipeline([
+        PipelineStage("fetch", fetch, workers=3),
+        PipelineStage("write", written.append)], queue_size=1, ordered=True)
+    
+    with pytest.raises(RuntimeError, match="`fetch`") as error_info:
+        pipeline.run(range(20))
+    assert isinstance(error_info.value.__cause__, KeyError)
+    assert written == [item for item in range(20) if item % 5 != 0]
+
+
+def test_items_returning_none_are_not_passed_on():
+    written = []
+    pipeline = StagedPipeline([
+        PipelineStage("filter", lambda item: item if item % 2 else None),
+        PipelineStage("write", written.append)], ordered=True)
+    pipeline.run(range(10))
+    
+    assert written == [1, 3, 5, 7, 9]
+
+
+def test_ordered_pipeline_needs_a_single_writer():
+    with pytest.raises(AssertionError):
+        StagedPipeline([PipelineStage("write", print, workers=2)], ordered=True)
@@ -0,0 +1,52 @@
+# tests of the run journal, which lets interrupted runs resume.
+import pytest
+from shapely.geometry import Point
+
+from run_journal import RunJournal
+from run_journal import make_location_key
+
+
+def test_resumed_journal_restores_the_last_states(tmp_path):
+    journal_path = str(tmp_path/"runs"/"journal.jsonl")
+    key = make_location_key(Point(1, 2), "2020-01-01")
+    journal = RunJournal(journal_path)
+    journal.record(0, key, "planned")
+    journal.record(0, key, "written")
+    journal.record(1, key, "failed", reason="no tiles")
+    journal.record(2, key, "fetched")
+    journal.close()
+    
+    resumed = RunJournal(journal_path)
+    assert resumed.get_summary() == {"planned": 0, "fetched": 1, "written": 1, "failed": 1}
+    assert resumed.is_finished(0, key)
+    assert resumed.is_finished(1, key)
+    assert not resumed.is_finished(1, key, retry_failed=True)
+    assert not resumed.is_finished(2, key)
+    # a changed key (e.g. a new date) is not finished
+    assert not resumed.is_finished(0, make_location_key(Point(1, 2), "2021-01-01"))
+    resumed.close()
+
+
+def test_cut_off_lines_are_skipped(tmp_path):
+    journal_path = str(tmp_path/"journal.jsonl")
+    journal = RunJournal(journal_path)
+    journal.record(0, "key", "written")
+    journal.close()
+    # a crash cuts off the last line
+    with open(journal_path, "a") as journal_file:
+        journal_file.write('{"index": 1, "key": "key", "st')
+    
+    resumed = RunJournal(journal_path)
+    resumed.record(2, "key", "written")
+    resumed.close()
+    
+    reloaded = RunJournal(journal_path)
+    assert reloaded.states == {0: "written", 2: "written"}
+    reloaded.close()
+
+
+def test_unknown_states_are_rejected(tmp_path):
+    journal = RunJournal(str(tmp_path/"journal.jsonl"))
+    with pytest.raises(AssertionError):
+        journal.record(0, "key", "done")
+    journal.close()
@@ -0,0 +1,55 @@
+# tests of the file helpers.
+import csv
+import hashlib
+
+from utils import make_fan_out_path
+from utils import migrate_csv_header
+
+
+def write_csv(filename, header, rows):
+    with open(filename, "w") as csv_file:
+        csv_writer = csv.DictWriter(csv_file, fieldnames=header)
+        csv_writer.writeheader()
+        csv_writer.writerows(rows)
+
+
+def read_csv(filename):
+    with open(filename, "r") as csv_file:
+        csv_reader = csv.DictReader(csv_file)
+        return csv_reader.fieldnames, list(csv_reader)
+
+
+def test_migrate_csv_header_adds_missing_columns(tmp_path):
+    filename = str(tmp_path/"index.csv")
+    write_csv(filename, ["index", "path"], [{"index": "1", "path": "a"},
+                                            {"index": "2", "path": "b"}])
+    
+    assert migrate_csv_header(filename, ["index", "path", "mean"], fill_value="NA")
+    header, rows = read_csv(filename)
+    assert header == ["index", "path", "mean"]
+    assert rows == [{"index": "1", "path": "a", "mean": "NA"},
+                    {"index": "2", "path": "b", "mean": "NA"}]
+    # a migrated file is left as it is
+    assert not migrate_csv_header(filename, ["index", "path", "mean"])
+
+
+def test_migrate_csv_header_keeps_other_files(tmp_path):
+    filename = str(tmp_path/"index.csv")
+    write_csv(filename, ["index", "unknown"], [{"index": "1", "unknown": "x"}])
+    
+    assert not migrate_csv_header(filename, ["index", "path"])
+    assert read_csv(filename) == (["index", "unknown"], [{"index": "1", "unknown": "x"}])
+    assert not migrate_csv_header(str(tmp_path/"missing.csv"), ["index"])
+
+
+def test_make_fan_out_path():
+    digest = hashlib.sha1(b"tile.tif").hexdigest()
+    
+    assert make_fan_out_path("database/rgb/tile.tif") == (
+        f"database/rgb/{digest[:2]}/{digest[2:4]}/tile.tif")
+    assert make_fan_out_path("database/rgb/tile.tif", levels=1, width=3) == (
+        f"database/rgb/{digest[:3]}/tile.tif")
+    assert make_fan_out_path("database/rgb/tile.tif", levels=0) == "database/rgb/tile.tif"
+    # the directories depend on the file name only
+    assert make_fan_out_path("other/tile.tif").split("/")[1:] == (
+        make_fan_out_path("database/rgb/tile.tif").split("/")[2:])